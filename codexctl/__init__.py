@@ -9,7 +9,9 @@ import tempfile
 import shutil
 import json
 import re
+import time
 
+from functools import cached_property
 from typing import cast
 from os import listdir
 
@@ -24,7 +26,6 @@ if importlib.util.find_spec("requests") is None:
     )
 
 from .device import HardwareType
-from .updates import UpdateManager
 
 
 class Manager:
@@ -41,7 +42,78 @@ class Manager:
         """
         self.device = device
         self.logger = logger
-        self.updater = UpdateManager(logger)
+
+    @cached_property
+    def updater(self):
+        """UpdateManager, created the first time a command needs it
+
+        Commands that only work on local images (ls, cat, extract, mount, ...)
+        never create it, so they don't import the network stack or read version-ids.json.
+        """
+        from .updates import UpdateManager
+
+        return UpdateManager(self.logger)
+
+    def open_remote_image(self, file: str, hardware_type: HardwareType | None):
+        """Opens an update image from a URL or version id, reading it with range requests where possible
+
+        SWU images are read in place. Older images, and servers without range
+        support, are downloaded first.
+
+        Args:
+            file (str): URL of the image, or a version id (or latest)
+            hardware_type (HardwareType | None): Type of the device, required for version ids
+
+        Returns:
+            tuple: The filesystem image and the ext4 volume inside it
+        """
+        from .analysis import get_remote_update_image, get_update_image
+        from .remote import HTTPRangeFile
+
+        if file.startswith(("http://", "https://")):
+            try:
+                return get_remote_update_image(
+                    HTTPRangeFile(file, self.updater.session, logger=self.logger)
+                )
+            except (OSError, ValueError) as error:
+                self.logger.debug(f"Could not read {file} in place: {error}")
+
+            location = self.updater.download_url(file, tempfile.gettempdir())
+            if location is None:
+                raise SystemExit(f"Failed to download {file}")
+
+            return get_update_image(location)
+
+        if hardware_type is None:
+            raise SystemExit(
+                f"{file} is not a file, a URL, or a version id with --hardware set"
+            )
+
+        version = file
+        if version == "latest":
+            version = self.updater.get_latest_version(hardware_type)
+
+        record = self.updater.get_version_index(hardware_type).get(version)
+        if record is None:
+            raise SystemExit(f"Version {version} not found in version-ids.json!")
+
+        location = self.updater.get_cached_version(hardware_type, version)
+        if location is None and record.new_engine:
+            remote = self.updater.open_remote_version(hardware_type, version)
+            if remote is not None:
+                try:
+                    return get_remote_update_image(remote)
+                except (OSError, ValueError) as error:
+                    self.logger.debug(f"Could not read {version} in place: {error}")
+
+        if location is None:
+            location = self.updater.download_version(
+                hardware_type, version, tempfile.gettempdir()
+            )
+            if location is None:
+                raise SystemExit(f"Failed to download {version}")
+
+        return get_update_image(location)
 
     def call_func(self, function: str, args: dict) -> None:
         """Runs a command based on the function name and arguments provided
@@ -53,9 +125,11 @@ class Manager:
 
         try:
             remarkable_version = HardwareType.parse(self.device)
+            hardware_types = [remarkable_version]
         except ValueError:
             hw = args.get("hardware")
-            remarkable_version = HardwareType.parse(hw) if hw else None
+            hardware_types = [HardwareType.parse(x) for x in hw.split(",")] if hw else []
+            remarkable_version = hardware_types[0] if len(hardware_types) == 1 else None
 
         version = cast(str | None, args.get("version", None))
 
@@ -67,36 +141,170 @@ class Manager:
 
         ### Download functionalities
         if function == "list":
-            remarkable_pp_versions = "\n".join(
-                self.updater.remarkablepp_versions.keys()
-            )
-            remarkable_ppm_versions = "\n".join(
-                self.updater.remarkableppm_versions.keys()
-            )
-            remarkable_2_versions = "\n".join(self.updater.remarkable2_versions.keys())
-            remarkable_1_versions = "\n".join(self.updater.remarkable1_versions.keys())
+            titles = {
+                HardwareType.RMPP: "ReMarkable Paper Pro",
+                HardwareType.RMPPM: "ReMarkable Paper Pro Move",
+                HardwareType.RM2: "ReMarkable 2",
+                HardwareType.RM1: "ReMarkable 1",
+            }
 
             version_blocks = []
-            if remarkable_version is None or remarkable_version == HardwareType.RMPP:
-                version_blocks.append(f"ReMarkable Paper Pro:\n{remarkable_pp_versions}")
-            if remarkable_version is None or remarkable_version == HardwareType.RMPPM:
-                version_blocks.append(f"ReMarkable Paper Pro Move:\n{remarkable_ppm_versions}")
-            if remarkable_version is None or remarkable_version == HardwareType.RM2:
-                version_blocks.append(f"ReMarkable 2:\n{remarkable_2_versions}")
-            if remarkable_version is None or remarkable_version == HardwareType.RM1:
-                version_blocks.append(f"ReMarkable 1:\n{remarkable_1_versions}")
+            for hardware_type, title in titles.items():
+                if hardware_types and hardware_type not in hardware_types:
+                    continue
+
+                index = self.updater.get_version_index(hardware_type)
+                if args["newer_than"] is not None:
+                    self.updater.check_version(args["newer_than"])
+                    records = index.newer_than(args["newer_than"])
+                else:
+                    records = list(index)
+
+                if args["version"]:
+                    wanted = set(
+                        self.updater.resolve_versions(hardware_type, args["version"])
+                    )
+                    records = [record for record in records if record.version in wanted]
+
+                versions = "\n".join(record.version for record in reversed(records))
+                version_blocks.append(f"{title}:\n{versions}")
 
             print("\n\n".join(version_blocks))
 
         elif function == "download":
-            logger.debug(f"Downloading version {version}")
-            assert remarkable_version is not None
-            filename = self.updater.download_version(
-                remarkable_version, version, args["out"]
+            from .cache import format_size
+
+            assert hardware_types
+            if not args["version"] and not args["all"]:
+                raise SystemExit("Please give a version to download, or --all")
+
+            targets = []
+            for hardware_type in hardware_types:
+                versions = (
+                    list(self.updater.get_versions(hardware_type))
+                    if args["all"]
+                    else args["version"]
+                )
+                targets.extend(
+                    (hardware_type, x)
+                    for x in self.updater.resolve_versions(hardware_type, versions)
+                )
+
+            if len(targets) == 1:
+                logger.debug(f"Downloading version {targets[0][1]}")
+                filename = self.updater.download_version(
+                    *targets[0], args["out"], args["connections"]
+                )
+
+                if filename:
+                    print(f"Sucessfully downloaded to {filename}")
+
+                return
+
+            print(f"Downloading {len(targets)} versions, {args['jobs']} at a time")
+            start = time.monotonic()
+            results = self.updater.download_versions(
+                targets, args["out"], args["jobs"], args["connections"]
             )
+            elapsed = time.monotonic() - start
+
+            downloaded = [filename for _, _, filename in results if filename]
+            size = sum(os.path.getsize(filename) for filename in downloaded)
+            print(
+                f"Downloaded {len(downloaded)} of {len(results)} versions ({format_size(size)}) "
+                f"in {elapsed:.1f}s ({format_size(size / elapsed if elapsed else 0)}/s)"
+            )
+
+            failed = [
+                f"{hardware_type.name} {update_version}"
+                for hardware_type, update_version, filename in results
+                if not filename
+            ]
+            if failed:
+                print("Failed to download:\n  " + "\n  ".join(failed))
+                raise SystemExit(1)
+
+        elif function == "cache":
+            from .cache import format_size, parse_size
+
+            cache = self.updater.cache
+            action = args["action"]
+
+            if action in ("pin", "unpin"):
+                if remarkable_version is None or args["value"] is None:
+                    raise SystemExit("A version and --hardware are required to pin a version")
+
+                version = args["value"]
+                if version == "latest":
+                    version = self.updater.get_latest_version(remarkable_version)
+
+                versions = self.updater.get_versions(remarkable_version)
+                if version not in versions:
+                    raise SystemExit(f"Version {version} not found in version-ids.json!")
 
-            if filename:
-                print(f"Sucessfully downloaded to {filename}")
+                if action == "pin":
+                    cache.pin(versions[version][1])
+                    print(f"Pinned {version}")
+                else:
+                    cache.unpin(versions[version][1])
+                    print(f"Unpinned {version}")
+
+            elif action == "limit":
+                if args["value"] is None:
+                    raise SystemExit("A size limit is required, e.g. 20G")
+
+                try:
+                    cache.set_max_size(parse_size(args["value"]))
+                except ValueError as error:
+                    raise SystemExit(str(error))
+
+                print(f"Cache limit set to {format_size(parse_size(args['value']))}")
+
+            elif action == "clear":
+                cache.clear()
+                print("Removed all unpinned firmware from the cache")
+
+            else:
+                stats = cache.stats()
+                lookups = stats["hits"] + stats["misses"]
+                hit_ratio = f"{stats['hits'] / lookups:.0%}" if lookups else "n/a"
+
+                print(f"Location: {cache.folder}")
+                print(f"Usage: {format_size(stats['size'])} / {format_size(stats['max-size'])}")
+                print(f"Files: {len(stats['entries'])} ({len(stats['pinned'])} pinned)")
+                print(f"Hits: {stats['hits']}, Misses: {stats['misses']} (hit ratio {hit_ratio})")
+
+                for checksum, entry in sorted(
+                    stats["entries"].items(),
+                    key=lambda item: item[1].get("last-access", 0),
+                    reverse=True,
+                ):
+                    pinned = " [pinned]" if checksum in stats["pinned"] else ""
+                    print(f"  {entry['name']} ({format_size(entry['size'])}){pinned}")
+
+        elif function == "mirror":
+            from .mirror import MirrorServer
+
+            versions = {
+                hardware_type: self.updater.get_versions(hardware_type)
+                for hardware_type in HardwareType
+            }
+
+            try:
+                httpd = MirrorServer(
+                    (args["host"], args["port"]), versions, self.updater.cache, logger
+                )
+            except OSError as error:
+                raise SystemExit(f"Could not start mirror on {args['host']}:{args['port']}: {error}")
+
+            host = args["host"] if args["host"] not in ("", "0.0.0.0") else "<this machine>"
+            print(f"Serving {self.updater.cache.folder} on {args['host']}:{args['port']}")
+            print(f"Add http://{host}:{args['port']}/REPLACE_ID to CODEXCTL_MIRRORS on other machines")
+
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                httpd.server_close()
 
         ### Mounting functionalities
         elif function in ("extract", "mount"):
@@ -154,7 +362,11 @@ class Manager:
                 )
 
             try:
-                image, volume = get_update_image(args["file"])
+                if os.path.exists(args["file"]):
+                    image, volume = get_update_image(args["file"])
+                else:
+                    image, volume = self.open_remote_image(args["file"], remarkable_version)
+
                 inode = volume.inode_at(args["target_path"])
 
             except FileNotFoundError:
@@ -216,6 +428,7 @@ class Manager:
 
             from .device import DeviceManager
             from .server import get_available_version
+            from .updates import UpdateManager
 
             remarkable = DeviceManager(
                 remote=remote,
@@ -236,10 +449,10 @@ class Manager:
                 )
 
             elif function == "restore":
+                # Read before restoring, the restore script uses the same (cached) status
+                backup = remarkable.get_device_status()[4]
                 remarkable.restore_previous_version()
-                print(
-                    f"Device restored to previous version [{remarkable.get_device_status()[4]}]"
-                )
+                print(f"Device restored to previous version [{backup}]")
                 remarkable.reboot_device()
                 print("Device rebooted")
 
@@ -248,6 +461,9 @@ class Manager:
                 made_update_folder = False
                 orig_cwd = os.getcwd()
 
+                # Resolved before changing into the folder the update is served from
+                event_log = os.path.abspath(args["event_log"]) if args["event_log"] else None
+
                 # Do we have a specific update file to serve?
 
                 update_file = version if os.path.isfile(version) else None
@@ -365,30 +581,43 @@ class Manager:
                         expected_swu_name = f"remarkable-production-memfault-image-{current_version}-{remarkable.hardware.new_download_hw}-public"
                         expected_swu_path = f"./{expected_swu_name}"
 
+                        cached_swu_path = self.updater.get_cached_version(
+                            remarkable.hardware, current_version
+                        )
+
+                        current_swu_path = None
                         if os.path.isfile(expected_swu_path):
                             print(f"\nUsing existing {expected_swu_name} for bootloader extraction...")
                             current_swu_path = expected_swu_path
+                        elif cached_swu_path:
+                            print(f"\nUsing cached {expected_swu_name} for bootloader extraction...")
+                            current_swu_path = cached_swu_path
                         else:
+                            # The bootloader is flashed, so it is only taken from a whole SWU that matches
+                            # version-ids.json. Reading just the two members would trust the SWU's
+                            # sw-description, whose signature codexctl has no certificate to check
                             print("\nDownloading current version's SWU for bootloader extraction...")
                             current_swu_path = self.updater.download_version(
                                 remarkable.hardware,
                                 current_version,
-                                "./"
+                                "./",
+                                args["connections"],
                             )
 
-                        if not current_swu_path:
-                            raise SystemError(
-                                f"Failed to download current version {current_version} for bootloader extraction. "
-                                f"This is required for safe downgrade across bootloader boundary."
-                            )
+                            if not current_swu_path:
+                                raise SystemError(
+                                    f"Failed to download current version {current_version} for bootloader extraction. "
+                                    f"This is required for safe downgrade across bootloader boundary."
+                                )
 
-                        print("Extracting bootloader files...")
-                        from remarkable_update_image import UpdateImage
-                        swu_image = UpdateImage(current_swu_path)
-                        bootloader_files_for_install = {
-                            'update-bootloader.sh': swu_image.archive[b'update-bootloader.sh'].read(),
-                            'imx-boot': swu_image.archive[b'imx-boot'].read(),
-                        }
+                        if current_swu_path is not None:
+                            print("Extracting bootloader files...")
+                            from remarkable_update_image import UpdateImage
+                            swu_image = UpdateImage(current_swu_path)
+                            bootloader_files_for_install = {
+                                'update-bootloader.sh': swu_image.archive[b'update-bootloader.sh'].read(),
+                                'imx-boot': swu_image.archive[b'imx-boot'].read(),
+                            }
 
                         if not all(bootloader_files_for_install.values()):
                             raise SystemError("Failed to extract bootloader files from current version")
@@ -411,7 +640,12 @@ class Manager:
                 # If version was a valid location file, update_file will be the location else it'll be a version number
 
                 if not update_file:
-                    temp_path = tempfile.mkdtemp()
+                    # Stable per version, so an interrupted download resumes on the next run
+                    temp_path = os.path.join(
+                        tempfile.gettempdir(),
+                        f"codexctl-{remarkable.hardware.new_download_hw}-{version}",
+                    )
+                    os.makedirs(temp_path, exist_ok=True)
                     os.chdir(temp_path)
 
                     print(f"Version {version} not found. Attempting to download")
@@ -421,7 +655,7 @@ class Manager:
                         location += "updates"
 
                     result = self.updater.download_version(
-                        remarkable.hardware, version, location
+                        remarkable.hardware, version, location, args["connections"]
                     )
                     if result:
                         print(f"Downloaded version {version} to {result}")
@@ -429,6 +663,15 @@ class Manager:
                         if device_version_uses_new_engine:
                             update_file = result
                         else:
+                            from .server import PayloadHashes
+
+                            # The fake updater only has to compute the sha1 of a verified download
+                            PayloadHashes().remember(
+                                result,
+                                self.updater.get_version_index(remarkable.hardware)
+                                .get(version)
+                                .checksum,
+                            )
                             update_file = get_available_version(version)
 
                     else:
@@ -439,7 +682,7 @@ class Manager:
                 if device_version_uses_new_engine:
                     remarkable.install_sw_update(update_file, bootloader_files=bootloader_files_for_install)
                 else:
-                    remarkable.install_ohma_update(update_file)
+                    remarkable.install_ohma_update(update_file, event_log)
 
                 if made_update_folder:  # Move update file back out
                     shutil.move(os.listdir("updates")[0], "../")
@@ -451,6 +694,19 @@ class Manager:
                     shutil.rmtree(temp_path)
 
 
+def positive_int(value: str) -> int:
+    """Argument type for counts that must be at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a whole number of at least 1, not {value}")
+
+    return number
+
+
 def main() -> None:
     """Main function for codexctl"""
 
@@ -488,21 +744,61 @@ def main() -> None:
         help="Install the specified version (will download if not available on the device)",
     )
     install.add_argument("version", help="Version (or location to file) to install")
+    install.add_argument(
+        "--connections",
+        "-c",
+        help="Number of connections to download the firmware over",
+        type=int,
+        default=1,
+        dest="connections",
+    )
+    install.add_argument(
+        "--event-log",
+        help="File to append the fake updater's events to as json lines (versions installed with the old update engine only)",
+        default=None,
+        dest="event_log",
+    )
 
     ### Download subcommand
     download = subparsers.add_parser(
         "download", help="Download the specified version firmware file"
     )
-    download.add_argument("version", help="Version to download")
+    download.add_argument(
+        "version",
+        help="Version(s) to download. Accepts latest, toltec and ranges such as 3.20..latest",
+        nargs="*",
+    )
     download.add_argument("--out", "-o", help="Folder to download to", default=None)
     download.add_argument(
         "--hardware",
         "--device",
         "-d",
-        help="Hardware to download for",
+        help="Hardware to download for, comma separated for several (e.g. rm1,rm2)",
         required=True,
         dest="hardware",
     )
+    download.add_argument(
+        "--all",
+        help="Download every version available for the hardware",
+        action="store_true",
+        dest="all",
+    )
+    download.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of versions to download at once",
+        type=positive_int,
+        default=4,
+        dest="jobs",
+    )
+    download.add_argument(
+        "--connections",
+        "-c",
+        help="Number of connections to download the firmware over",
+        type=int,
+        default=1,
+        dest="connections",
+    )
 
     ### Backup subcommand
     backup = subparsers.add_parser(
@@ -547,13 +843,31 @@ def main() -> None:
     cat = subparsers.add_parser(
         "cat", help="Cat the contents of a file inside a firmwareimage"
     )
-    cat.add_argument("file", help="Path to update file to cat", default=None)
+    cat.add_argument(
+        "file", help="Path, URL or version id of update file to cat", default=None
+    )
     cat.add_argument("target_path", help="Path inside the image to list", default=None)
+    cat.add_argument(
+        "--hardware",
+        "--device",
+        "-d",
+        help="Hardware of the version id to cat",
+        dest="hardware",
+    )
 
     ### Ls subcommand
     ls = subparsers.add_parser("ls", help="List files inside a firmware image")
-    ls.add_argument("file", help="Path to update file to extract", default=None)
+    ls.add_argument(
+        "file", help="Path, URL or version id of update file to list", default=None
+    )
     ls.add_argument("target_path", help="Path inside the image to list", default=None)
+    ls.add_argument(
+        "--hardware",
+        "--device",
+        "-d",
+        help="Hardware of the version id to list",
+        dest="hardware",
+    )
 
     ### Extract subcommand
     extract = subparsers.add_parser(
@@ -600,6 +914,11 @@ def main() -> None:
 
     ### List subcommand
     list_ = subparsers.add_parser("list", help="List all available versions")
+    list_.add_argument(
+        "version",
+        help="Only list these versions. Accepts latest, toltec and ranges such as 3.20..latest",
+        nargs="*",
+    )
     list_.add_argument(
         "--hardware",
         "--device",
@@ -607,6 +926,49 @@ def main() -> None:
         help="Hardware to list for",
         dest="hardware",
     )
+    list_.add_argument(
+        "--newer-than",
+        help="Only list versions newer than this one (e.g. the version on a device)",
+        default=None,
+        dest="newer_than",
+    )
+
+    ### Cache subcommand
+    cache = subparsers.add_parser(
+        "cache", help="Show firmware cache usage, pin versions or set its size limit"
+    )
+    cache.add_argument(
+        "action",
+        help="What to do with the cache. Defaults to status",
+        choices=["status", "pin", "unpin", "limit", "clear"],
+        nargs="?",
+        default="status",
+    )
+    cache.add_argument(
+        "value",
+        help="Version to pin/unpin, or size limit (e.g. 20G)",
+        nargs="?",
+        default=None,
+    )
+    cache.add_argument(
+        "--hardware",
+        "--device",
+        "-d",
+        help="Hardware of the version to pin/unpin",
+        dest="hardware",
+    )
+
+    ### Mirror subcommand
+    mirror = subparsers.add_parser(
+        "mirror", help="Serve the firmware cache to other codexctl instances"
+    )
+    mirror.add_argument("action", help="What to do", choices=["serve"])
+    mirror.add_argument(
+        "--host", help="Address to listen on", default="0.0.0.0", dest="host"
+    )
+    mirror.add_argument(
+        "--port", help="Port to listen on", type=int, default=8090, dest="port"
+    )
 
     ### Setting logging level
     args = parser.parse_args()
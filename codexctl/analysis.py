@@ -1,4 +1,6 @@
 import ext4
+import io
+import struct
 import warnings
 import errno
 
@@ -32,3 +34,57 @@ def get_update_image(file: str):
         warnings.warn("Unable to open public key", RuntimeWarning)
 
     return image, volume
+
+
+def get_remote_update_image(file):
+    """Opens the filesystem inside a SWU update image without reading the whole image
+
+    Only the archive headers and the blocks of the root filesystem that are
+    actually read are fetched, which makes this suited to a `HTTPRangeFile`.
+    Gzip compressed filesystems can only be read forwards, so everything up to
+    the furthest block that is read is fetched.
+
+    Args:
+        file (file object): Seekable binary file containing a SWU image
+
+    Returns:
+        tuple: The filesystem image and the ext4 volume inside it
+
+    Raises:
+        ValueError: If the file isn't a SWU image
+    """
+    from .remote import CPIOArchive, FileSlice
+
+    archive = CPIOArchive(file)
+
+    members = sorted(
+        (name for name in archive.members if name != "sw-description"),
+        key=lambda name: (".ext4" in name, archive.members[name][1]),
+    )
+    if not members:
+        raise ValueError("SWU image has no filesystem")
+
+    name = members[-1]
+    image = archive.open(name)
+    if name.endswith(".gz"):
+        import indexed_gzip
+
+        stream = indexed_gzip.IndexedGzipFile(
+            fileobj=io.BufferedReader(image), drop_handles=False
+        )
+
+        # The size of a gzip stream is only known once it's fully read, so take it from the superblock
+        stream.seek(1024)
+        superblock = stream.read(0x154)
+        blocks = struct.unpack_from("<I", superblock, 0x4)[0]
+        if struct.unpack_from("<I", superblock, 0x60)[0] & 0x80:  # 64bit feature
+            blocks |= struct.unpack_from("<I", superblock, 0x150)[0] << 32
+
+        image = FileSlice(
+            stream, 0, blocks * 1024 << struct.unpack_from("<I", superblock, 0x18)[0]
+        )
+
+    warnings.warn("Signature of remote images isn't checked", RuntimeWarning)
+
+    image = io.BufferedReader(image)
+    return image, ext4.Volume(image, offset=0)
@@ -0,0 +1,431 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+import requests
+
+DEFAULT_MAX_SIZE = 10 * 1024**3  # 10 GiB
+DEFAULT_METADATA_TTL = 24 * 60 * 60  # Seconds before metadata is revalidated
+METADATA_TIMEOUT = 10  # Seconds to wait for a metadata server to respond
+
+
+def get_cache_folder() -> str:
+    """Gets the folder codexctl caches downloads in
+
+    Returns:
+        str: Location of the cache folder, `CODEXCTL_CACHE_DIR` if it is set
+    """
+    if "CODEXCTL_CACHE_DIR" in os.environ:
+        return os.environ["CODEXCTL_CACHE_DIR"]
+
+    if os.name == "nt":  # Windows
+        return os.getenv("LOCALAPPDATA") + "/codexctl"
+    elif os.name in ("posix", "darwin"):  # Linux or MacOS
+        return os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")) + "/codexctl"
+
+    raise SystemError("Unsupported OS")
+
+
+def parse_size(size: str) -> int:
+    """Parses a human readable size such as `500M` or `20G` into bytes"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", size, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {size}")
+
+    exponent = " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * 1024**exponent)
+
+
+def format_size(size: int) -> str:
+    """Formats a number of bytes as a human readable size"""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+
+    return f"{size:.1f} TiB"
+
+
+class FirmwareCache:
+    def __init__(self, location: str | None = None, logger=None) -> None:
+        """Content addressed cache of verified firmware files
+
+        Files are stored under the sha256 listed for them in version-ids.json,
+        and are only added once that checksum has been verified. An index next
+        to the files tracks their size and last access, so the least recently
+        used files can be evicted once the cache grows past its size limit.
+        Pinned files are never evicted.
+
+        Args:
+            location (str, optional): Location of the cache. Defaults to `get_cache_folder()`.
+            logger (logger, optional): Logger object for logging. Defaults to None.
+        """
+        self.logger = logger
+
+        if self.logger is None:
+            self.logger = logging
+
+        if location is None:
+            location = get_cache_folder()
+
+        self.folder = f"{location}/firmware"
+        self.index_location = f"{self.folder}/index.json"
+        self.lock = threading.Lock()
+
+    def path_for(self, checksum: str) -> str:
+        """Returns where the file with the given sha256 is stored in the cache"""
+        return f"{self.folder}/{checksum}"
+
+    def peek(self, checksum: str) -> str | None:
+        """Looks up a file in the cache without recording the hit or miss, or touching its last access
+
+        Args:
+            checksum (str): Sha256 of the file
+
+        Returns:
+            str | None: Location of the cached file, None if it is not cached
+        """
+        path = self.path_for(checksum)
+        return path if os.path.isfile(path) else None
+
+    def get(self, checksum: str) -> str | None:
+        """Looks up a file in the cache, recording the hit or miss
+
+        Args:
+            checksum (str): Sha256 of the file
+
+        Returns:
+            str | None: Location of the cached file, None if it is not cached
+        """
+        path = self.path_for(checksum)
+
+        with self.lock:
+            index = self.__load_index()
+            entry = index["entries"].get(checksum)
+
+            if entry is None and os.path.isfile(path):  # Cached before the index existed
+                entry = index["entries"][checksum] = {
+                    "name": checksum,
+                    "size": os.path.getsize(path),
+                }
+
+            if entry is None or not os.path.isfile(path):
+                self.logger.debug(f"Cache miss for {checksum}")
+                index["misses"] += 1
+                self.__save_index(index)
+                return None
+
+            self.logger.debug(f"Cache hit for {checksum}")
+            index["hits"] += 1
+            entry["last-access"] = time.time()
+            self.__save_index(index)
+
+        return path
+
+    def add(self, filename: str, checksum: str) -> str:
+        """Adds a verified file to the cache, evicting old files if it is over its limit
+
+        Args:
+            filename (str): Location of the file
+            checksum (str): Sha256 of the file
+
+        Returns:
+            str: Location of the cached file
+        """
+        os.makedirs(self.folder, exist_ok=True)
+
+        path = self.path_for(checksum)
+        self.__link(filename, path)
+        self.logger.debug(f"Cached {filename} as {path}")
+
+        with self.lock:
+            index = self.__load_index()
+            index["entries"][checksum] = {
+                "name": os.path.basename(filename),
+                "size": os.path.getsize(path),
+                "last-access": time.time(),
+            }
+            self.__evict(index, keep=checksum)
+            self.__save_index(index)
+
+        return path
+
+    def export(self, checksum: str, download_folder: str, name: str) -> str:
+        """Places a cached file in a download folder
+
+        Args:
+            checksum (str): Sha256 of the file
+            download_folder (str): Location of download folder
+            name (str): Name to give the file
+
+        Returns:
+            str: Location of the exported file
+        """
+        filename = f"{download_folder}/{name}"
+        self.__link(self.path_for(checksum), filename)
+
+        return filename
+
+    def pin(self, checksum: str) -> None:
+        """Stops a file from being evicted, even if it is not cached yet"""
+        with self.lock:
+            index = self.__load_index()
+            if checksum not in index["pinned"]:
+                index["pinned"].append(checksum)
+            self.__save_index(index)
+
+    def unpin(self, checksum: str) -> None:
+        """Allows a pinned file to be evicted again"""
+        with self.lock:
+            index = self.__load_index()
+            if checksum in index["pinned"]:
+                index["pinned"].remove(checksum)
+            self.__evict(index)
+            self.__save_index(index)
+
+    def set_max_size(self, max_size: int) -> None:
+        """Sets the size limit of the cache, evicting files that no longer fit"""
+        with self.lock:
+            index = self.__load_index()
+            index["max-size"] = max_size
+            self.__evict(index)
+            self.__save_index(index)
+
+    def clear(self) -> None:
+        """Removes every file that is not pinned"""
+        with self.lock:
+            index = self.__load_index()
+            for checksum in list(index["entries"]):
+                if checksum not in index["pinned"]:
+                    self.__remove(index, checksum)
+            self.__save_index(index)
+
+    def stats(self) -> dict:
+        """Gets the usage of the cache
+
+        Returns:
+            dict: Size, limit, hits, misses, entries and pinned checksums of the cache
+        """
+        with self.lock:
+            index = self.__load_index()
+
+        return {
+            "size": sum(entry["size"] for entry in index["entries"].values()),
+            "max-size": index["max-size"],
+            "hits": index["hits"],
+            "misses": index["misses"],
+            "entries": index["entries"],
+            "pinned": index["pinned"],
+        }
+
+    def __evict(self, index: dict, keep: str | None = None) -> None:
+        """Removes the least recently used files until the cache fits in its limit"""
+        for checksum in list(index["entries"]):
+            if not os.path.isfile(self.path_for(checksum)):
+                del index["entries"][checksum]
+
+        size = sum(entry["size"] for entry in index["entries"].values())
+        candidates = sorted(
+            (
+                checksum
+                for checksum in index["entries"]
+                if checksum not in index["pinned"] and checksum != keep
+            ),
+            key=lambda checksum: index["entries"][checksum]["last-access"],
+        )
+
+        for checksum in candidates:
+            if size <= index["max-size"]:
+                break
+
+            size -= index["entries"][checksum]["size"]
+            self.logger.debug(f"Evicting {index['entries'][checksum]['name']} from cache")
+            self.__remove(index, checksum)
+
+        if size > index["max-size"]:
+            self.logger.warning(
+                f"Firmware cache is {format_size(size)}, over its {format_size(index['max-size'])} limit, as the rest is pinned or in use"
+            )
+
+    def __remove(self, index: dict, checksum: str) -> None:
+        """Removes a file from the cache and its index"""
+        path = self.path_for(checksum)
+        if os.path.exists(path):
+            os.remove(path)
+
+        del index["entries"][checksum]
+
+    def __load_index(self) -> dict:
+        """Reads the index, which may have been changed by other processes"""
+        index = {
+            "max-size": DEFAULT_MAX_SIZE,
+            "hits": 0,
+            "misses": 0,
+            "pinned": [],
+            "entries": {},
+        }
+
+        try:
+            with open(self.index_location) as f:
+                index.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            self.logger.warning(f"Firmware cache index at {self.index_location} is corrupted, resetting it")
+
+        return index
+
+    def __save_index(self, index: dict) -> None:
+        """Atomically writes the index"""
+        os.makedirs(self.folder, exist_ok=True)
+
+        with open(f"{self.index_location}.tmp", "w") as f:
+            json.dump(index, f, indent=4)
+        os.replace(f"{self.index_location}.tmp", self.index_location)
+
+    @staticmethod
+    def __link(source: str, destination: str) -> None:
+        """Hard links (or copies, across filesystems) a file, replacing the destination atomically"""
+        temp_destination = f"{destination}.tmp"
+        if os.path.exists(temp_destination):
+            os.remove(temp_destination)
+
+        try:
+            os.link(source, temp_destination)
+        except OSError:
+            shutil.copyfile(source, temp_destination)
+
+        os.replace(temp_destination, destination)
+
+
+class MetadataCache:
+    def __init__(
+        self,
+        session: requests.Session,
+        location: str | None = None,
+        ttl: int | None = None,
+        logger=None,
+    ) -> None:
+        """HTTP cache for small metadata files such as version-ids.json
+
+        Files fetched within the TTL are served without any request. Older
+        files are revalidated with a conditional request using their ETag or
+        Last-Modified, and the cached copy is served if the server can't be
+        reached.
+
+        Args:
+            session (requests.Session): Session to make requests with
+            location (str, optional): Location of the cache. Defaults to `get_cache_folder()`.
+            ttl (int, optional): Seconds a file is used without revalidating it. Defaults to `CODEXCTL_METADATA_TTL` or DEFAULT_METADATA_TTL.
+            logger (logger, optional): Logger object for logging. Defaults to None.
+        """
+        self.session = session
+        self.logger = logger
+        self.ttl = ttl
+
+        if self.logger is None:
+            self.logger = logging
+
+        if location is None:
+            location = get_cache_folder()
+
+        if self.ttl is None:
+            self.ttl = int(os.getenv("CODEXCTL_METADATA_TTL", DEFAULT_METADATA_TTL))
+
+        self.folder = f"{location}/metadata"
+        self.memory = {}
+
+    def get(self, url: str, filename: str | None = None, validate=None) -> str:
+        """Gets the contents of a url, from the cache if it is still fresh
+
+        Args:
+            url (str): Location of the file
+            filename (str, optional): Where to keep the file. Defaults to a file in the cache folder.
+            validate (callable, optional): Called with new contents before they are stored, raises ValueError if they are invalid.
+
+        Returns:
+            str: Contents of the file
+
+        Raises:
+            requests.exceptions.RequestException: If the file can't be fetched and isn't cached
+            ValueError: If the fetched file is invalid and isn't cached
+        """
+        key = hashlib.sha1(f"{url} {filename}".encode()).hexdigest()
+        if key in self.memory:
+            return self.memory[key]
+
+        if filename is None:
+            filename = f"{self.folder}/{key}"
+
+        state_location = f"{self.folder}/{key}.json"
+        try:
+            with open(state_location) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+
+        cached = os.path.isfile(filename)
+        if cached and time.time() - state.get("fetched-at", 0) < self.ttl:
+            self.logger.debug(f"Using cached {url}")
+            return self.__remember(key, filename)
+
+        headers = {}
+        if cached and "etag" in state:
+            headers["If-None-Match"] = state["etag"]
+        if cached and "last-modified" in state:
+            headers["If-Modified-Since"] = state["last-modified"]
+
+        try:
+            self.logger.debug(f"Fetching {url}")
+            response = self.session.get(url, headers=headers, timeout=METADATA_TIMEOUT)
+
+            if response.status_code == 304 and cached:
+                self.logger.debug(f"{url} has not changed")
+            elif response.status_code == 200:
+                if validate is not None:
+                    validate(response.text)
+
+                os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+                with open(f"{filename}.tmp", "wb") as f:
+                    f.write(response.content)
+                os.replace(f"{filename}.tmp", filename)
+
+                state = {
+                    key: value
+                    for key, value in (
+                        ("etag", response.headers.get("etag")),
+                        ("last-modified", response.headers.get("last-modified")),
+                    )
+                    if value is not None
+                }
+            else:
+                raise requests.exceptions.HTTPError(
+                    f"{url} responded with {response.status_code}", response=response
+                )
+
+        except (requests.exceptions.RequestException, ValueError) as error:
+            if not cached:
+                raise
+
+            self.logger.warning(f"Could not refresh {url}, using cached copy: {error}")
+            return self.__remember(key, filename)
+
+        state["fetched-at"] = time.time()
+        os.makedirs(self.folder, exist_ok=True)
+        with open(f"{state_location}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{state_location}.tmp", state_location)
+
+        return self.__remember(key, filename)
+
+    def __remember(self, key: str, filename: str) -> str:
+        """Reads a cached file and keeps its contents in memory for the rest of the run"""
+        with open(filename, encoding="utf-8") as f:
+            self.memory[key] = f.read()
+
+        return self.memory[key]
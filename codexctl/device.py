@@ -1,4 +1,5 @@
 import enum
+import json
 import logging
 import os
 import re
@@ -6,10 +7,70 @@ import shlex
 import socket
 import subprocess
 import tempfile
-import threading
 import time
 
-from .server import startUpdate
+UPDATE_EVENT_TIMEOUT = 60  # Seconds to wait for the device to report the result of an update
+
+# Collects everything `get_device_status` needs in one exec channel and prints it as json.
+# Expects ACTIVE_DEVICE_COMMAND to be set to the command printing the active root device.
+STATUS_SCRIPT = r"""
+clean() { printf '%s' "$1" | tr -d '"\\' | tr '\n\r\t' '   '; }
+
+value() { sed -n "s/.*$1=//p" "$2" 2>/dev/null | head -n 1; }
+
+version() {
+    if [ -f "$1/usr/share/remarkable/update.conf" ]; then
+        file="$1/usr/share/remarkable/update.conf"
+        key=REMARKABLE_RELEASE_VERSION
+    elif [ -f "$1/etc/os-release" ]; then
+        file="$1/etc/os-release"
+        key=IMG_VERSION
+    else
+        printf '{"file": null, "version": null}'
+        return
+    fi
+
+    if grep -q "$key=" "$file"; then
+        printf '{"file": "%s", "version": "%s"}' "$file" "$(clean "$(value $key "$file")")"
+    else
+        printf '{"file": "%s", "version": null}' "$file"
+    fi
+}
+
+backup() {
+    # Only stdout is the device, warnings on stderr are kept for the error
+    error_file=$(mktemp)
+    active=$($ACTIVE_DEVICE_COMMAND 2>"$error_file")
+    status=$?
+    error=$(cat "$error_file")
+    rm -f "$error_file"
+
+    if [ "$status" -ne 0 ] || [ -z "$active" ]; then
+        printf '{"error": "%s"}' "$(clean "Failed to get active device using '$ACTIVE_DEVICE_COMMAND': ${error:-${active:-no output}}")"
+        return
+    fi
+
+    if [ "${active##*p}" = 2 ]; then inactive=3; else inactive=2; fi
+    mount_point="/tmp/mount_p$inactive"
+
+    mkdir -p "$mount_point"
+    if error=$(mount -o ro "${active%p*}p$inactive" "$mount_point" 2>&1); then
+        version "$mount_point"
+        umount "$mount_point"
+    else
+        printf '{"error": "%s"}' "$(clean "Failed to mount backup partition: $error")"
+    fi
+    rmdir "$mount_point" 2>/dev/null
+}
+
+group=null
+if grep -q "GROUP=" /home/root/.config/remarkable/xochitl.conf 2>/dev/null; then
+    group="\"$(clean "$(value GROUP /home/root/.config/remarkable/xochitl.conf)")\""
+fi
+
+printf '{"current": %s, "version_id": "%s", "group": %s, "backup": %s}\n' \
+    "$(version "")" "$(clean "$(cat /etc/version 2>/dev/null)")" "$group" "$(backup)"
+"""
 
 try:
     import paramiko
@@ -107,6 +168,10 @@ class DeviceManager:
         self.authentication = authentication
         self.client = None
 
+        self.__sftp = None
+        self.__sftp_client = None
+        self.__status = None
+
         if self.logger is None:
             self.logger = logging
 
@@ -118,8 +183,7 @@ class DeviceManager:
             self.client.authentication = authentication
             self.client.address = address
 
-            ftp = self.client.open_sftp()
-            with ftp.file("/sys/devices/soc0/machine") as file:
+            with self.sftp.file("/sys/devices/soc0/machine") as file:
                 machine_contents = file.read().decode("utf-8").strip("\n")
         else:
             with open("/sys/devices/soc0/machine") as file:
@@ -127,6 +191,24 @@ class DeviceManager:
 
         self.hardware = HardwareType.parse(machine_contents)
 
+    @property
+    def sftp(self) -> "paramiko.SFTPClient":
+        """SFTP session on the device, opened on first use and kept for the life of the connection
+
+        A new session is opened after `client` is replaced (e.g. on reconnecting
+        after a reboot) or the session's channel was closed.
+        """
+        if (
+            self.__sftp is None
+            or self.__sftp_client is not self.client
+            or self.__sftp.sock.closed
+        ):
+            self.logger.debug("Opening SFTP session")
+            self.__sftp = self.client.open_sftp()
+            self.__sftp_client = self.client
+
+        return self.__sftp
+
     def get_host_address(self) -> list[str] | list | None:  # Interaction required
         """Gets the IP address of the host machine
 
@@ -292,53 +374,6 @@ class DeviceManager:
 
         return client
 
-    def _read_version_from_path(self, ftp=None, base_path: str = "") -> tuple[str, bool]:
-        """Reads version from a given path (current partition or mounted backup)
-
-        Args:
-            ftp: SFTP client connection (None for local file access)
-            base_path: Base path prefix (empty for current partition, /tmp/mount_pX for backup)
-
-        Returns:
-            tuple: (version_string, old_update_engine_boolean)
-        """
-        update_conf_path = f"{base_path}/usr/share/remarkable/update.conf" if base_path else "/usr/share/remarkable/update.conf"
-        os_release_path = f"{base_path}/etc/os-release" if base_path else "/etc/os-release"
-
-        if ftp:
-            def file_exists(path: str) -> bool:
-                try:
-                    ftp.stat(path)
-                    return True
-                except FileNotFoundError:
-                    return False
-
-            def read_file(path: str) -> str:
-                with ftp.file(path) as file:
-                    return file.read().decode("utf-8")
-        else:
-            file_exists = os.path.exists
-
-            def read_file(path: str) -> str:
-                with open(path, encoding="utf-8") as file:
-                    return file.read()
-
-        if file_exists(update_conf_path):
-            contents = read_file(update_conf_path).strip("\n")
-            match = re.search("(?<=REMARKABLE_RELEASE_VERSION=).*", contents)
-            if match:
-                return match.group(), True
-            raise SystemError(f"REMARKABLE_RELEASE_VERSION not found in {update_conf_path}")
-
-        if file_exists(os_release_path):
-            contents = read_file(os_release_path)
-            match = re.search("(?<=IMG_VERSION=).*", contents)
-            if match:
-                return match.group().strip('"'), False
-            raise SystemError(f"IMG_VERSION not found in {os_release_path}")
-
-        raise SystemError(f"Cannot read version from {base_path or 'current partition'}: no version file found")
-
     def _get_active_device(self) -> str:
         """Gets the active root device path.
 
@@ -381,58 +416,6 @@ class DeviceManager:
         device_base = re.sub(r'p\d+$', '', active_device)
         return active_part, inactive_part, device_base
 
-    def _get_backup_partition_version(self) -> str:
-        """Gets the version installed on the backup (inactive) partition
-
-        Returns:
-            str: Version string (empty string for RM1/RM2 on failure)
-
-        Raises:
-            SystemError: If backup partition version cannot be determined (Paper Pro only)
-        """
-        try:
-            active_device = self._get_active_device()
-            _, inactive_part, device_base = self._parse_partition_info(active_device)
-            mount_point = f"/tmp/mount_p{inactive_part}"
-
-            if self.client:
-                ftp = self.client.open_sftp()
-                self.client.exec_command(f"mkdir -p {mount_point}")
-                _stdin, stdout, _stderr = self.client.exec_command(
-                    f"mount -o ro {device_base}p{inactive_part} {mount_point}"
-                )
-                exit_status = stdout.channel.recv_exit_status()
-
-                if exit_status != 0:
-                    error_msg = _stderr.read().decode('utf-8')
-                    raise SystemError(f"Failed to mount backup partition: {error_msg}")
-
-                try:
-                    version, _ = self._read_version_from_path(ftp, mount_point)
-                    return version
-                finally:
-                    self.client.exec_command(f"umount {mount_point}")
-                    self.client.exec_command(f"rm -rf {mount_point}")
-            else:
-                os.makedirs(mount_point, exist_ok=True)
-                result = subprocess.run(
-                    ["mount", "-o", "ro", f"{device_base}p{inactive_part}", mount_point],
-                    capture_output=True, text=True
-                )
-                if result.returncode != 0:
-                    raise SystemError(f"Failed to mount backup partition: {result.stderr}")
-
-                try:
-                    version, _ = self._read_version_from_path(base_path=mount_point)
-                    return version
-                finally:
-                    subprocess.run(["umount", mount_point])
-                    subprocess.run(["rm", "-rf", mount_point])
-        except SystemError:
-            if self.hardware in (HardwareType.RMPP, HardwareType.RMPPM):
-                raise
-            return ""
-
     def _get_paper_pro_partition_info(self, current_version: str) -> tuple[int, int, int]:
         """Gets partition information for Paper Pro devices
 
@@ -454,7 +437,7 @@ class DeviceManager:
         next_boot_part = current_part
 
         if self.client:
-            ftp = self.client.open_sftp()
+            ftp = self.sftp
 
             def file_exists(path: str) -> bool:
                 try:
@@ -495,57 +478,105 @@ class DeviceManager:
 
         return current_part, inactive_part, next_boot_part
 
-    def get_device_status(self) -> tuple[str | None, str, str, str, str]:
-        """Gets the status of the device
+    def _probe_status(self) -> dict:
+        """Reads the versions and update group of the device with a single script
 
         Returns:
-            tuple: Beta status, old_update_engine, current version, version_id, backup version (in that order)
+            dict: Status printed by `STATUS_SCRIPT`
+
+        Raises:
+            SystemError: If the script didn't print a status
         """
-        old_update_engine = True
-        version_id = ""
-        beta_contents = ""
+        if self.hardware in (HardwareType.RMPP, HardwareType.RMPPM):
+            command = "swupdate -g"
+        else:
+            command = "rootdev"
+
+        script = f"ACTIVE_DEVICE_COMMAND='{command}'\n{STATUS_SCRIPT}"
 
         if self.client:
-            self.logger.debug("Connecting to FTP")
-            ftp = self.client.open_sftp()
-            self.logger.debug("Connected")
+            _stdin, stdout, stderr = self.client.exec_command(script)
+            output = stdout.read().decode("utf-8", errors="replace")
+            error = stderr.read().decode("utf-8", errors="replace")
+        else:
+            result = subprocess.run(["sh", "-c", script], capture_output=True, text=True)
+            output, error = result.stdout, result.stderr
 
-            xochitl_version, old_update_engine = self._read_version_from_path(ftp)
-            def exists(path:str) -> bool:
-                try:
-                    _ = ftp.stat(path)
-                    return True
-                except (FileNotFoundError, IOError):
-                    return False
+        try:
+            return json.loads(output)
+        except ValueError:
+            raise SystemError(f"Failed to read device status: {error or output}") from None
 
-            if exists("/etc/version"):
-                with ftp.file("/etc/version") as file:
-                    version_id = file.read().decode("utf-8").strip("\n")
+    @staticmethod
+    def _parse_probed_version(probed: dict, location: str) -> tuple[str, bool]:
+        """Gets the version and update engine of a partition from the status script
 
-            if exists("/home/root/.config/remarkable/xochitl.conf"):
-                with ftp.file("/home/root/.config/remarkable/xochitl.conf") as file:
-                    beta_contents = file.read().decode("utf-8")
+        Args:
+            probed (dict): Version entry printed by `STATUS_SCRIPT`
+            location (str): Name of the partition, for errors
 
-        else:
-            xochitl_version, old_update_engine = self._read_version_from_path()
+        Returns:
+            tuple: (version_string, old_update_engine_boolean)
 
-            if os.path.exists("/etc/version"):
-                with open("/etc/version", encoding="utf-8") as file:
-                    version_id = file.read().rstrip()
+        Raises:
+            SystemError: If the partition has no version
+        """
+        if probed["file"] is None:
+            raise SystemError(f"Cannot read version from {location}: no version file found")
+
+        if probed["version"] is None:
+            key = "IMG_VERSION" if probed["file"].endswith("os-release") else "REMARKABLE_RELEASE_VERSION"
+            raise SystemError(f"{key} not found in {probed['file']}")
+
+        return probed["version"], probed["file"].endswith("update.conf")
+
+    def get_device_status(self) -> tuple[str | None, str, str, str, str]:
+        """Gets the status of the device
 
-            if os.path.exists("/home/root/.config/remarkable/xochitl.conf"):
-                with open("/home/root/.config/remarkable/xochitl.conf", encoding="utf-8") as file:
-                    beta_contents = file.read().rstrip()
+        Everything is read by one script, so this is a single round trip on remote devices.
+        The status is then cached until `invalidate_status` is called, which the methods
+        that change the device (installing, restoring and rebooting) do.
+
+        Returns:
+            tuple: Beta status, old_update_engine, current version, version_id, backup version (in that order)
+        """
+        if self.__status is not None:
+            return self.__status
+
+        status = self._probe_status()
+
+        xochitl_version, old_update_engine = self._parse_probed_version(
+            status["current"], "current partition"
+        )
 
-        beta_possible = re.search("(?<=GROUP=).*", beta_contents)
-        beta = "Release"
+        beta = status["group"]
+        if beta is None:
+            beta = "Release"
 
-        if beta_possible is not None:
-            beta = re.search("(?<=GROUP=).*", beta_contents).group()
+        try:
+            if "error" in status["backup"]:
+                raise SystemError(status["backup"]["error"])
 
-        backup_version = self._get_backup_partition_version()
+            backup_version, _ = self._parse_probed_version(
+                status["backup"], "backup partition"
+            )
+        except SystemError:
+            if self.hardware in (HardwareType.RMPP, HardwareType.RMPPM):
+                raise
+            backup_version = ""
+
+        self.__status = (
+            beta,
+            old_update_engine,
+            xochitl_version,
+            status["version_id"],
+            backup_version,
+        )
+        return self.__status
 
-        return beta, old_update_engine, xochitl_version, version_id, backup_version
+    def invalidate_status(self) -> None:
+        """Discards the cached status, so the next `get_device_status` reads it from the device again"""
+        self.__status = None
 
     def set_server_config(self, contents: str, server_host_name: str) -> str:
         """Converts the contents given to point to the given server IP and port
@@ -606,16 +637,12 @@ class DeviceManager:
 
                 return True
 
-            self.logger.debug("Connecting to FTP")
-            ftp = self.client.open_sftp()  # or ssh
-            self.logger.debug("Connected")
-
-            with ftp.file("/usr/share/remarkable/update.conf") as update_conf_file:
+            with self.sftp.file("/usr/share/remarkable/update.conf") as update_conf_file:
                 modified_conf_version = self.set_server_config(
                     update_conf_file.read().decode("utf-8"), server_host_name
                 )
 
-            with ftp.file("/usr/share/remarkable/update.conf", "w") as update_conf_file:
+            with self.sftp.file("/usr/share/remarkable/update.conf", "w") as update_conf_file:
                 update_conf_file.write(modified_conf_version)
 
             return True
@@ -685,12 +712,10 @@ echo "fallback: ${OLDPART}"
 
             RESTORE_CODE = "\n".join(code)
 
-        if self.client:
-            self.logger.debug("Connecting to FTP")
-            ftp = self.client.open_sftp()
-            self.logger.debug("Connected")
+        self.invalidate_status()
 
-            with ftp.file("/tmp/restore.sh", "w") as file:
+        if self.client:
+            with self.sftp.file("/tmp/restore.sh", "w") as file:
                 file.write(RESTORE_CODE)
 
             self.logger.debug("Setting permissions and running restore.sh")
@@ -716,11 +741,10 @@ else
     systemctl reboot
 fi
 """
+        self.invalidate_status()
+
         if self.client:
-            self.logger.debug("Connecting to FTP")
-            ftp = self.client.open_sftp()
-            self.logger.debug("Connected")
-            with ftp.file("/tmp/reboot.sh", "w") as file:
+            with self.sftp.file("/tmp/reboot.sh", "w") as file:
                 file.write(REBOOT_CODE)
 
             self.logger.debug("Running reboot.sh")
@@ -747,13 +771,13 @@ fi
             SystemExit: If there was an error installing the update
 
         """
-        if self.client:
-            ftp_client = self.client.open_sftp()
+        self.invalidate_status()
 
+        if self.client:
             print(f"Uploading {version_file} image")
 
             out_location = f"/tmp/{os.path.basename(version_file)}.swu"
-            ftp_client.put(
+            self.sftp.put(
                 version_file, out_location, callback=self.output_put_progress
             )
 
@@ -843,9 +867,8 @@ fi
         if not self.client:
             raise SystemError("No SSH connection to device")
 
-        ftp_client = None
         try:
-            ftp_client = self.client.open_sftp()
+            ftp_client = self.sftp
         except Exception:
             raise SystemError("Failed to open SFTP connection for bootloader update")
 
@@ -898,18 +921,18 @@ fi
             self.logger.debug("Cleaning up local temporary files")
             os.unlink(tmp_script_path)
             os.unlink(tmp_boot_path)
-            if ftp_client:
-                ftp_client.close()
 
-    def install_ohma_update(self, version_available: dict) -> None:
+    def install_ohma_update(self, version_available: dict, event_log: str | None = None) -> None:
         """Installs version from update folder on the device
 
         Args:
             version_available (dict): Version available for installation from `get_available_version`
+            event_log (str, optional): File to append the fake updater's events to as json lines. Defaults to None.
 
         Raises:
             SystemExit: If there was an error installing the update
         """
+        self.invalidate_status()
 
         server_host = self.get_host_address()
 
@@ -922,18 +945,35 @@ fi
 
             return
 
-        thread = threading.Thread(
-            target=startUpdate, args=(version_available, server_host, 8085), daemon=True
+        from .metrics import UpdateMetrics
+        from .omaha import AsyncUpdateServer
+
+        if not version_available:
+            raise SystemError("Could not find any update files")
+
+        updater = AsyncUpdateServer(
+            (server_host, 8085),
+            version_available,
+            metrics=UpdateMetrics(event_log, self.logger),
+            logger=self.logger,
         )
-        thread.start()
+        try:
+            updater.start_thread()
+        except OSError as error:
+            raise SystemError(
+                f"Could not start fake updater: {error}. Is the port already in use?"
+            ) from error
 
-        self.logger.debug("Thread started")
+        # Hash the payloads while the device is getting ready, instead of on its first request
+        updater.prepare()
+
+        self.logger.debug(f"Fake updater listening on {server_host}:8085")
 
         if self.client:
             print("Checking if device can connect to this machine")
 
             _stdin, stdout, _stderr = self.client.exec_command(
-                f"sleep 2 && echo | nc {server_host} 8085"
+                f"echo | nc {server_host} 8085"
             )
             check = stdout.channel.recv_exit_status()
             self.logger.debug(f"Stdout of nc checking: {stdout.readlines()}")
@@ -960,6 +1000,8 @@ fi
                 f"Stdout of update checking service is {''.join(_stderr.readlines())}"
             )
 
+            self._check_update_event(updater)
+
             #### Now disable automatic updates
 
             print("Done! Now rebooting the device and disabling update service")
@@ -1011,9 +1053,33 @@ fi
                     f"Stdout of update checking service is {''.join(process.stderr.readlines())}"
                 )
 
+            self._check_update_event(updater)
+
             print("Update complete and device rebooting")
             os.system("reboot")
 
+    def _check_update_event(self, updater) -> None:
+        """Waits for the device to report the result of its update to the fake updater
+
+        Args:
+            updater (AsyncUpdateServer): Fake updater the device is updating from
+
+        Raises:
+            SystemError: If the device reported an error
+        """
+        try:
+            event = updater.completion(timeout=UPDATE_EVENT_TIMEOUT)
+        except TimeoutError:
+            self.logger.warning("Device did not report the result of the update")
+            return
+
+        if not event.success:
+            raise SystemError(
+                f"Device reported an error while updating (error code {event.error_code})"
+            )
+
+        self.logger.debug(f"Device finished the update with event {event}")
+
     @staticmethod
     def output_put_progress(transferred: int, toBeTransferred: int) -> None:
         """Used for displaying progress for paramiko ftp.put function"""
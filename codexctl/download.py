@@ -0,0 +1,515 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .session import create_session
+
+CHUNK_SIZE = 65536  # Bytes read (and hashed) per iteration while downloading
+SEGMENT_SIZE = 8 * 1024 * 1024  # Size of each HTTP Range request in ranged mode
+PROBE_TIMEOUT = 10  # Seconds to wait for a mirror to respond
+STALL_TIMEOUT = 30  # Seconds without data before a range request is given up on
+MAX_MIRROR_FAILURES = 3  # Failed range requests before a mirror is no longer used
+
+
+def print_progress(done: int, total: int) -> None:
+    """Draws the download progress bar when running in a terminal"""
+    if not sys.stdout.isatty():
+        return
+
+    filled = int(50 * done / total)
+    sys.stdout.write("\r[%s%s]" % ("=" * filled, " " * (50 - filled)))
+    sys.stdout.flush()
+
+
+def hash_file(path: str, length: int | None = None, file_hash=None):
+    """Hashes a file, reading it in `CHUNK_SIZE` blocks
+
+    Args:
+        path (str): Location of the file
+        length (int, optional): Only hash the first `length` bytes. Defaults to the whole file.
+        file_hash (optional): Hash object to update. If given it is returned instead of the hex digest.
+
+    Returns:
+        str: Sha256 of the file, or the updated hash object if one was given
+    """
+    digest = file_hash is None
+    if digest:
+        file_hash = hashlib.sha256()
+
+    remaining = length
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+            data = f.read(size)
+            if not data:
+                break
+
+            file_hash.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+
+    return file_hash.hexdigest() if digest else file_hash
+
+
+def supports_ranges(response: requests.Response) -> bool:
+    """Checks if the server advertised byte range support for the response"""
+    return response.headers.get("accept-ranges", "").lower() == "bytes"
+
+
+def get_validator(response: requests.Response) -> str | None:
+    """Returns the ETag (or Last-Modified) of a response for use with If-Range"""
+    return response.headers.get("etag") or response.headers.get("last-modified")
+
+
+class DownloadState:
+    def __init__(
+        self, filename: str, size: int, validator: str | None, checksum: str | None = None
+    ) -> None:
+        """Records which byte ranges of a `.part` file have been downloaded
+
+        The state is kept in a small json sidecar next to the file so an
+        interrupted download can be resumed with range requests.
+
+        Args:
+            filename (str): Location of the partial file
+            size (int): Total size of the file in bytes
+            validator (str | None): ETag or Last-Modified of the file on the server
+            checksum (str, optional): Sha256 the finished file is checked against. Defaults to None.
+        """
+        self.filename = filename
+        self.sidecar = f"{filename}.json"
+        self.size = size
+        self.validator = validator
+        self.checksum = checksum
+        self.completed: list[list[int]] = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(
+        cls, filename: str, size: int, validator: str | None, checksum: str | None = None
+    ) -> "DownloadState":
+        """Loads the state of a previous download, if it is for the same file
+
+        A download checked against a sha256 can be resumed from any server
+        serving a file of the same size, as the checksum catches a different file.
+
+        Args:
+            filename (str): Location of the partial file
+            size (int): Total size of the file in bytes
+            validator (str | None): ETag or Last-Modified of the file on the server
+            checksum (str, optional): Sha256 the finished file is checked against. Defaults to None.
+
+        Returns:
+            DownloadState: Previous state, or an empty state if it cannot be resumed
+        """
+        state = cls(filename, size, validator, checksum)
+
+        try:
+            with open(state.sidecar) as f:
+                contents = json.load(f)
+        except (OSError, ValueError):
+            return state
+
+        if (
+            contents.get("size") != size
+            or (
+                contents.get("validator") != validator
+                and (checksum is None or contents.get("checksum") != checksum)
+            )
+            or not os.path.exists(filename)
+            or os.path.getsize(filename) > size
+        ):
+            return state
+
+        for start, end in contents.get("completed", []):
+            state.add(start, end, save=False)
+
+        return state
+
+    def add(self, start: int, end: int, save: bool = True) -> None:
+        """Marks the inclusive byte range `start`-`end` as downloaded"""
+        with self.lock:
+            ranges = sorted(self.completed + [[start, end]])
+            self.completed = [ranges[0]]
+            for range_start, range_end in ranges[1:]:
+                if range_start <= self.completed[-1][1] + 1:
+                    self.completed[-1][1] = max(self.completed[-1][1], range_end)
+                else:
+                    self.completed.append([range_start, range_end])
+
+            if save:
+                self.save()
+
+    def prefix(self) -> int:
+        """Returns the number of contiguous bytes downloaded from the start"""
+        if self.completed and self.completed[0][0] == 0:
+            return self.completed[0][1] + 1
+
+        return 0
+
+    def missing(self, segment_size: int = SEGMENT_SIZE) -> list[tuple[int, int]]:
+        """Returns the byte ranges that still need downloading, split into segments"""
+        segments = []
+        position = 0
+        for start, end in self.completed + [[self.size, self.size]]:
+            for segment_start in range(position, start, segment_size):
+                segments.append(
+                    (segment_start, min(segment_start + segment_size, start) - 1)
+                )
+            position = max(position, end + 1)
+
+        return segments
+
+    def reset(self) -> None:
+        """Forgets every downloaded range"""
+        with self.lock:
+            self.completed = []
+            self.save()
+
+    def save(self) -> None:
+        """Atomically writes the state to the sidecar"""
+        with open(f"{self.sidecar}.tmp", "w") as f:
+            json.dump(
+                {
+                    "size": self.size,
+                    "validator": self.validator,
+                    "checksum": self.checksum,
+                    "completed": self.completed,
+                },
+                f,
+            )
+        os.replace(f"{self.sidecar}.tmp", self.sidecar)
+
+    def remove(self) -> None:
+        """Removes the sidecar once the download has finished"""
+        if os.path.exists(self.sidecar):
+            os.remove(self.sidecar)
+
+
+def stream_download(
+    response: requests.Response,
+    uri: str,
+    state: DownloadState,
+    logger=None,
+    progress: bool = True,
+    session: requests.Session | None = None,
+) -> str | None:
+    """Downloads a file over a single connection, hashing it while it is written
+
+    If part of the file was already downloaded, the rest is requested with a
+    range request and the existing bytes are hashed from disk.
+
+    Args:
+        response (requests.Response): Streamed response for the whole file
+        uri (str): Location of the file
+        state (DownloadState): State of the partial file to write to
+        logger (logger, optional): Logger object for logging. Defaults to None.
+        progress (bool, optional): Whether to draw a progress bar. Defaults to True.
+        session (requests.Session, optional): Session to make requests with. Defaults to a new session.
+
+    Returns:
+        str | None: Sha256 of the file if it was downloaded, None otherwise
+    """
+    if logger is None:
+        logger = logging
+
+    if session is None:
+        session = create_session()
+
+    offset = state.prefix() if supports_ranges(response) else 0
+    if offset:
+        logger.debug(f"Resuming download of {state.filename} from byte {offset}")
+        response.close()
+
+        headers = {"Range": f"bytes={offset}-"}
+        if state.validator:
+            headers["If-Range"] = state.validator
+
+        response = session.get(uri, headers=headers, stream=True)
+        if response.status_code == 200:
+            logger.debug("Server sent the whole file, restarting download")
+            offset = 0
+        elif response.status_code != 206:
+            logger.debug(f"Unable to resume download: {response.status_code}")
+            return None
+
+    if offset:
+        file_hash = hash_file(state.filename, offset, hashlib.sha256())
+        mode = "r+b"
+
+        # Ranges a ranged download wrote past the offset are truncated away below
+        state.reset()
+        state.add(0, offset - 1)
+    else:
+        file_hash = hashlib.sha256()
+        mode = "wb"
+        state.reset()
+
+    dl = saved = offset
+    try:
+        with open(state.filename, mode) as out_file:
+            out_file.seek(offset)
+            out_file.truncate()
+
+            for data in response.iter_content(chunk_size=CHUNK_SIZE):
+                dl += len(data)
+                file_hash.update(data)
+                out_file.write(data)
+                if progress:
+                    print_progress(dl, state.size)
+
+                if dl - saved >= SEGMENT_SIZE:
+                    out_file.flush()
+                    state.add(0, dl - 1)
+                    saved = dl
+
+    except requests.exceptions.RequestException as error:
+        if dl:
+            state.add(0, dl - 1)
+        logger.error(f"Download interrupted after {dl} bytes, run again to resume: {error}")
+        return None
+
+    finally:
+        if progress and sys.stdout.isatty():
+            print(end="\r\n")
+
+    if dl != state.size:
+        if dl:
+            state.add(0, dl - 1)
+        logger.error(f"Download ended after {dl} of {state.size} bytes, run again to resume")
+        return None
+
+    return file_hash.hexdigest()
+
+
+class Mirror:
+    def __init__(self, uri: str) -> None:
+        """Result of probing a mirror that serves a firmware file
+
+        Args:
+            uri (str): Location of the file on the mirror
+        """
+        self.uri = uri
+        self.latency: float | None = None
+        self.size: int | None = None
+        self.ranges = False
+
+
+def probe_mirrors(
+    uris: list[str], logger=None, session: requests.Session | None = None
+) -> list[Mirror]:
+    """Probes every mirror at once with a HEAD request (or the first byte of a GET)
+
+    Args:
+        uris (list[str]): Location of the file on each mirror
+        logger (logger, optional): Logger object for logging. Defaults to None.
+        session (requests.Session, optional): Session to make requests with. Defaults to a new session.
+
+    Returns:
+        list[Mirror]: Reachable mirrors, fastest first
+    """
+    if logger is None:
+        logger = logging
+
+    if session is None:
+        session = create_session()
+
+    def probe(uri: str) -> Mirror:
+        mirror = Mirror(uri)
+        try:
+            start = time.monotonic()
+            response = session.head(uri, allow_redirects=True, timeout=PROBE_TIMEOUT)
+            if response.status_code != 200:
+                start = time.monotonic()
+                response = session.get(uri, stream=True, timeout=PROBE_TIMEOUT)
+                response.close()
+        except requests.exceptions.RequestException as error:
+            logger.debug(f"Mirror {uri} is unreachable: {error}")
+            return mirror
+
+        if response.status_code != 200:
+            logger.debug(f"Mirror {uri} responded with {response.status_code}")
+            return mirror
+
+        mirror.latency = time.monotonic() - start
+        mirror.ranges = supports_ranges(response)
+        if response.headers.get("content-length", "").isdigit():
+            mirror.size = int(response.headers["content-length"])
+
+        logger.debug(f"Mirror {uri} responded in {mirror.latency:.3f}s")
+        return mirror
+
+    with ThreadPoolExecutor(max_workers=max(len(uris), 1)) as executor:
+        mirrors = list(executor.map(probe, uris))
+
+    return sorted(
+        [mirror for mirror in mirrors if mirror.latency is not None],
+        key=lambda mirror: mirror.latency,
+    )
+
+
+class RangedDownload:
+    def __init__(
+        self,
+        uris: list[str],
+        state: DownloadState,
+        connections: int = 4,
+        segment_size: int = SEGMENT_SIZE,
+        logger=None,
+        progress: bool = True,
+        session: requests.Session | None = None,
+    ) -> None:
+        """Downloads a file as HTTP Range segments over several connections
+
+        Segments are written with positional writes into a file preallocated to
+        the full size, so they can complete in any order. Completed segments
+        are recorded in `state`, and segments already downloaded are skipped.
+
+        Connections are spread over the mirrors in `uris`, fastest first. If a
+        mirror fails or stalls, the rest of its segment goes back in the queue
+        for the other connections, and after `MAX_MIRROR_FAILURES` failures the
+        mirror is no longer used.
+
+        Args:
+            uris (list[str]): Location of the file on each mirror, preferred mirror first
+            state (DownloadState): State of the partial file to write to
+            connections (int, optional): Number of concurrent connections. Defaults to 4.
+            segment_size (int, optional): Size of each range request. Defaults to SEGMENT_SIZE.
+            logger (logger, optional): Logger object for logging. Defaults to None.
+            progress (bool, optional): Whether to draw a progress bar. Defaults to True.
+            session (requests.Session, optional): Session to make requests with. Defaults to a new session.
+        """
+        self.uris = uris
+        self.state = state
+        self.filename = state.filename
+        self.size = state.size
+        self.connections = connections
+        self.segment_size = segment_size
+        self.logger = logger
+        self.progress = progress
+        self.session = session
+
+        if self.logger is None:
+            self.logger = logging
+
+        if self.session is None:
+            self.session = create_session(connections)
+
+        self.segments = queue.SimpleQueue()
+        self.failed = threading.Event()
+        self.failures = {uri: 0 for uri in uris}
+        self.downloaded = 0
+        self.lock = threading.Lock()
+
+    def run(self) -> bool:
+        """Downloads every missing segment of the file
+
+        Returns:
+            bool: True if every segment was downloaded, False otherwise
+        """
+        with open(self.filename, "ab") as out_file:
+            out_file.truncate(self.size)
+
+        missing = self.state.missing(self.segment_size)
+        self.downloaded = self.size - sum(end - start + 1 for start, end in missing)
+        if self.downloaded:
+            self.logger.debug(f"Resuming download of {self.filename}, {self.downloaded} bytes done")
+
+        for segment in missing:
+            self.segments.put(segment)
+
+        workers = [
+            threading.Thread(target=self.__worker, args=(index,), daemon=True)
+            for index in range(min(self.connections, len(missing)))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if self.progress and sys.stdout.isatty():
+            print(end="\r\n")
+
+        return not self.failed.is_set()
+
+    def __mirror_for(self, index: int) -> str | None:
+        """Returns the mirror the `index`th connection should use, if any are healthy"""
+        with self.lock:
+            healthy = [
+                uri for uri in self.uris if self.failures[uri] < MAX_MIRROR_FAILURES
+            ]
+
+        return healthy[index % len(healthy)] if healthy else None
+
+    def __worker(self, index: int) -> None:
+        """Fetches segments from the queue until it is empty or every mirror failed"""
+        with open(self.filename, "r+b") as out_file:
+            while not self.failed.is_set():
+                try:
+                    start, end = self.segments.get_nowait()
+                except queue.Empty:
+                    return
+
+                uri = self.__mirror_for(index)
+                if uri is None:
+                    self.logger.error("Every mirror failed, giving up")
+                    self.failed.set()
+                    return
+
+                written = 0
+                try:
+                    for data in self.__fetch_segment(uri, start, end):
+                        out_file.seek(start + written)
+                        out_file.write(data)
+                        written += len(data)
+
+                        with self.lock:
+                            self.downloaded += len(data)
+                            if self.progress:
+                                print_progress(self.downloaded, self.size)
+
+                    if written != end - start + 1:
+                        raise ValueError(f"Expected {end - start + 1} bytes, got {written}")
+
+                except (requests.exceptions.RequestException, OSError, ValueError) as error:
+                    self.logger.debug(
+                        f"Failed to download bytes {start + written}-{end} from {uri}: {error}"
+                    )
+                    with self.lock:
+                        self.failures[uri] += 1
+
+                    out_file.flush()
+                    if written:
+                        self.state.add(start, start + written - 1)
+                    self.segments.put((start + written, end))
+                    continue
+
+                out_file.flush()
+                self.state.add(start, end)
+
+    def __fetch_segment(self, uri: str, start: int, end: int):
+        """Requests a single byte range from a mirror and yields its contents"""
+        headers = {"Range": f"bytes={start}-{end}"}
+        if self.state.validator and uri == self.uris[0]:
+            headers["If-Range"] = self.state.validator
+
+        response = self.session.get(
+            uri, headers=headers, stream=True, timeout=(PROBE_TIMEOUT, STALL_TIMEOUT)
+        )
+        if response.status_code != 206:
+            raise ValueError(f"Server responded with {response.status_code}")
+
+        content_range = response.headers.get("content-range", "")
+        if not content_range.endswith(f"/{self.size}"):
+            raise ValueError(f"Unexpected content range {content_range}")
+
+        yield from response.iter_content(chunk_size=CHUNK_SIZE)
@@ -0,0 +1,204 @@
+import email.utils
+import logging
+import os
+import re
+import socket
+
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024  # Send buffer for file transfers
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Parses a single range Range header
+
+    Args:
+        header (str): Value of the Range header
+        size (int): Size of the file being requested
+
+    Returns:
+        tuple[int, int] | None: Inclusive start and end of the range, None if it can't be satisfied
+
+    Raises:
+        ValueError: If the header isn't a single byte range, which should be ignored
+    """
+    match = RANGE_PATTERN.fullmatch(header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        raise ValueError(f"Unsupported range {header}")
+
+    start, end = match.groups()
+    if start == "":  # Suffix range, the last `end` bytes
+        if int(end) == 0:
+            return None
+
+        return max(size - int(end), 0), size - 1
+
+    if int(start) >= size:
+        return None
+
+    if end == "" or int(end) >= size:
+        return int(start), size - 1
+
+    if int(end) < int(start):
+        raise ValueError(f"Invalid range {header}")
+
+    return int(start), int(end)
+
+
+def file_response(
+    stat: os.stat_result,
+    etag: str | None,
+    range_header: str | None,
+    if_range: str | None,
+    if_none_match: str | None = None,
+    if_modified_since: str | None = None,
+) -> tuple[HTTPStatus, dict[str, str], int, int]:
+    """Works out the response to a request for a file, honouring Range, If-Range and conditional requests
+
+    Args:
+        stat (os.stat_result): Status of the open file
+        etag (str | None): ETag of the file, None to derive one from its status
+        range_header (str | None): Value of the Range header of the request
+        if_range (str | None): Value of the If-Range header of the request
+        if_none_match (str | None, optional): Value of the If-None-Match header of the request. Defaults to None.
+        if_modified_since (str | None, optional): Value of the If-Modified-Since header of the request, ignored if If-None-Match is set. Defaults to None.
+
+    Returns:
+        tuple[HTTPStatus, dict[str, str], int, int]: Status, headers, and the offset and length of the file to send
+    """
+    size = stat.st_size
+    if etag is None:
+        etag = f'"{stat.st_ino:x}-{size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = email.utils.formatdate(int(stat.st_mtime), usegmt=True)
+
+    # Clients revalidating a cached copy only need to hear that it is still current
+    not_modified = False
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == "*" or etag in (
+            tag.strip() for tag in if_none_match.split(",")
+        )
+    elif if_modified_since is not None:
+        try:
+            modified_since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            pass
+        else:
+            not_modified = int(stat.st_mtime) <= modified_since
+
+    if not_modified:
+        return HTTPStatus.NOT_MODIFIED, {"ETag": etag, "Last-Modified": last_modified}, 0, 0
+
+    status, start, end = HTTPStatus.OK, 0, size - 1
+
+    # A stale If-Range means the client's partial copy is outdated, so send everything
+    if range_header is not None and if_range in (None, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            byte_range = (0, size - 1)
+        else:
+            status = HTTPStatus.PARTIAL_CONTENT
+
+        if byte_range is None:
+            return (
+                HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                {"Content-Range": f"bytes */{size}", "Content-Length": "0"},
+                0,
+                0,
+            )
+
+        start, end = byte_range
+
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "Content-Length": str(end - start + 1),
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": last_modified,
+    }
+    if status == HTTPStatus.PARTIAL_CONTENT:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    return status, headers, start, end - start + 1
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    """Request handler that serves files with HEAD, Range, If-Range and conditional request support
+
+    Subclasses implement `resolve` to map a request path to a file.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self) -> None:
+        super().setup()
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
+    def handle(self) -> None:
+        try:
+            super().handle()
+        except ConnectionResetError as error:
+            # Clients reset idle keep-alive connections, e.g. after abandoning a response
+            logging.debug(f"{self.address_string()} reset the connection: {error}")
+
+    def resolve(self, path: str) -> tuple[str, str | None] | None:
+        """Maps a request path to a file
+
+        Args:
+            path (str): Path of the request
+
+        Returns:
+            tuple[str, str | None] | None: Location of the file and its ETag (or None to derive one), None if there is no such file
+        """
+        raise NotImplementedError()
+
+    def do_GET(self) -> None:
+        self.send_file(self.resolve(self.path))
+
+    def do_HEAD(self) -> None:
+        self.send_file(self.resolve(self.path), head=True)
+
+    def send_file(self, resolved: tuple[str, str | None] | None, head: bool = False) -> None:
+        """Sends a file, or the byte range of it that was requested
+
+        Args:
+            resolved (tuple[str, str | None] | None): Location and ETag of the file, as returned by `resolve`
+            head (bool, optional): Only send the headers. Defaults to False.
+        """
+        if resolved is None or not os.path.isfile(resolved[0]):
+            self.send_error(404)
+            return
+
+        location, etag = resolved
+        with open(location, "rb") as f:
+            status, headers, offset, length = file_response(
+                os.fstat(f.fileno()),
+                etag,
+                self.headers.get("Range"),
+                self.headers.get("If-Range"),
+                self.headers.get("If-None-Match"),
+                self.headers.get("If-Modified-Since"),
+            )
+
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+
+            if head or length == 0:
+                return
+
+            f.seek(offset)
+            try:
+                self.copy_file(f, length)
+            except (BrokenPipeError, ConnectionResetError) as error:
+                # Clients hang up early to resume later, or to switch to range requests
+                logging.debug(f"{self.address_string()} disconnected during transfer: {error}")
+                self.close_connection = True
+
+    def copy_file(self, f, length: int) -> None:
+        """Sends `length` bytes from the current position of a file to the client, with sendfile where supported"""
+        self.connection.sendfile(f, f.tell(), length)
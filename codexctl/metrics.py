@@ -0,0 +1,230 @@
+import json
+import logging
+import threading
+import time
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class DeviceMetrics:
+    def __init__(self, address: str) -> None:
+        """Transfer figures of one device, as seen by the fake updater
+
+        Args:
+            address (str): IP address of the device
+        """
+        self.address = address
+        self.machine_id = None
+        self.version = None
+        self.bytes_served = 0
+        self.transfer_seconds = 0.0
+        self.active_transfers = 0
+        self.ttfb = {}  # Request kind -> seconds until the response started
+        self.updatecheck_at = None
+        self.update_seconds = None  # Updatecheck to completion
+        self.errors = {}  # (event type, error code) -> count
+        self.last_activity = time.time()
+
+    @property
+    def throughput(self) -> float:
+        """Average payload bytes sent per second spent transferring"""
+        return self.bytes_served / self.transfer_seconds if self.transfer_seconds else 0.0
+
+
+class UpdateMetrics:
+    def __init__(self, event_log: str | None = None, logger=None) -> None:
+        """Per device accounting of a fake updater, with an OpenMetrics view and a structured event log
+
+        Devices are tracked by IP address, as payload downloads don't carry
+        a machine id. The machine id from the device's Omaha requests is
+        attached once it is known.
+
+        Args:
+            event_log (str, optional): File to append the event log to as json lines. Defaults to only logging at debug level.
+            logger (logger, optional): Logger object for logging. Defaults to None.
+        """
+        self.event_log = event_log
+        self.logger = logger
+        self.devices = {}
+        self.lock = threading.Lock()
+
+        if self.logger is None:
+            self.logger = logging
+
+    def updatecheck(
+        self, address: str, machine_id: str | None, version: str | None, ttfb: float
+    ) -> None:
+        """Records an update check
+
+        Args:
+            address (str): IP address of the device
+            machine_id (str | None): Machine id sent by the device
+            version (str | None): Version the device is running
+            ttfb (float): Seconds until the response started
+        """
+        with self.lock:
+            device = self.__device(address, machine_id)
+            device.version = version
+            device.ttfb["updatecheck"] = ttfb
+            device.updatecheck_at = time.monotonic()
+            device.update_seconds = None
+
+        self.__log("updatecheck", address, machine_id=machine_id, version=version, ttfb=ttfb)
+
+    def start_transfer(self, address: str, name: str, offset: int, length: int, ttfb: float) -> None:
+        """Records the start of a payload transfer
+
+        Args:
+            address (str): IP address of the device
+            name (str): File name of the payload
+            offset (int): First byte sent
+            length (int): Bytes to send
+            ttfb (float): Seconds until the response started
+        """
+        with self.lock:
+            device = self.__device(address)
+            device.active_transfers += 1
+            device.ttfb["payload"] = ttfb
+
+        self.__log("transfer_start", address, payload=name, offset=offset, length=length, ttfb=ttfb)
+
+    def add_bytes(self, address: str, count: int, seconds: float) -> None:
+        """Records part of a payload transfer, so stalled and slow devices show up before it ends"""
+        with self.lock:
+            device = self.__device(address)
+            device.bytes_served += count
+            device.transfer_seconds += seconds
+
+    def finish_transfer(self, address: str, name: str, sent: int, seconds: float, complete: bool) -> None:
+        """Records the end of a payload transfer
+
+        Args:
+            address (str): IP address of the device
+            name (str): File name of the payload
+            sent (int): Bytes sent
+            seconds (float): Duration of the transfer
+            complete (bool): Whether every requested byte was sent
+        """
+        with self.lock:
+            self.__device(address).active_transfers -= 1
+
+        self.__log(
+            "transfer_end",
+            address,
+            payload=name,
+            sent=sent,
+            seconds=seconds,
+            complete=complete,
+        )
+
+    def event(
+        self,
+        address: str,
+        machine_id: str | None,
+        event_type: int,
+        result: int,
+        error_code: str | None,
+        finished: bool,
+    ) -> None:
+        """Records an Omaha event
+
+        Args:
+            address (str): IP address of the device
+            machine_id (str | None): Machine id sent by the device
+            event_type (int): Omaha eventtype
+            result (int): Omaha eventresult, 0 for an error
+            error_code (str | None): Omaha errorcode
+            finished (bool): Whether the event finished the update
+        """
+        with self.lock:
+            device = self.__device(address, machine_id)
+            if result == 0:
+                key = (event_type, error_code or "")
+                device.errors[key] = device.errors.get(key, 0) + 1
+
+            if finished and device.updatecheck_at is not None:
+                device.update_seconds = time.monotonic() - device.updatecheck_at
+
+        self.__log(
+            "event",
+            address,
+            machine_id=machine_id,
+            event_type=event_type,
+            result=result,
+            error_code=error_code,
+        )
+
+    def render(self) -> str:
+        """Renders the metrics of every device in the OpenMetrics text format"""
+        families = {
+            "bytes_served": ("counter", "Payload bytes sent to the device", []),
+            "throughput_bytes_per_second": ("gauge", "Average payload transfer rate", []),
+            "active_transfers": ("gauge", "Payload transfers in progress", []),
+            "time_to_first_byte_seconds": ("gauge", "Time until the last response started", []),
+            "update_duration_seconds": ("gauge", "Time from update check to the update finishing", []),
+            "last_activity_timestamp_seconds": ("gauge", "Last time the device was seen", []),
+            "errors": ("counter", "Failed events reported by the device", []),
+        }
+
+        with self.lock:
+            for device in self.devices.values():
+                labels = {"address": device.address, "machine_id": device.machine_id or ""}
+
+                families["bytes_served"][2].append(("_total", labels, device.bytes_served))
+                families["throughput_bytes_per_second"][2].append(("", labels, device.throughput))
+                families["active_transfers"][2].append(("", labels, device.active_transfers))
+                families["last_activity_timestamp_seconds"][2].append(("", labels, device.last_activity))
+
+                for kind, ttfb in device.ttfb.items():
+                    families["time_to_first_byte_seconds"][2].append(
+                        ("", labels | {"request": kind}, ttfb)
+                    )
+
+                if device.update_seconds is not None:
+                    families["update_duration_seconds"][2].append(("", labels, device.update_seconds))
+
+                for (event_type, error_code), count in device.errors.items():
+                    families["errors"][2].append(
+                        (
+                            "_total",
+                            labels | {"event_type": str(event_type), "error_code": error_code},
+                            count,
+                        )
+                    )
+
+        lines = []
+        for name, (kind, help_text, samples) in families.items():
+            lines.append(f"# TYPE codexctl_updater_{name} {kind}")
+            lines.append(f"# HELP codexctl_updater_{name} {help_text}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(
+                    f'{key}="{self.__escape(value)}"' for key, value in labels.items()
+                )
+                lines.append(f"codexctl_updater_{name}{suffix}{{{label_text}}} {value}")
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def __device(self, address: str, machine_id: str | None = None) -> DeviceMetrics:
+        """Gets the metrics of a device, creating them on first sight. Must hold the lock"""
+        if address not in self.devices:
+            self.devices[address] = DeviceMetrics(address)
+
+        device = self.devices[address]
+        device.last_activity = time.time()
+        if machine_id:
+            device.machine_id = machine_id
+
+        return device
+
+    def __log(self, kind: str, address: str, **fields) -> None:
+        line = json.dumps({"time": time.time(), "kind": kind, "address": address} | fields)
+        self.logger.debug(line)
+
+        if self.event_log is not None:
+            with self.lock, open(self.event_log, "a") as f:
+                f.write(line + "\n")
+
+    @staticmethod
+    def __escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
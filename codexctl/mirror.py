@@ -0,0 +1,64 @@
+import logging
+
+from http.server import ThreadingHTTPServer
+
+from .cache import FirmwareCache
+from .device import HardwareType
+from .fileserver import FileRequestHandler
+
+
+class MirrorRequestHandler(FileRequestHandler):
+    """Serves cached firmware at /<version file id>, the layout used by external provider URLs"""
+
+    def resolve(self, path: str) -> tuple[str, str | None] | None:
+        checksum = self.server.checksums.get(path.split("?")[0].strip("/"))
+        if checksum is None:
+            return None
+
+        # Striped and resumed downloads make many requests for one file, which shouldn't count as cache hits
+        location = self.server.cache.peek(checksum)
+        if location is None:
+            return None
+
+        # Cached firmware is stored by sha256, which makes a strong validator
+        return location, f'"{checksum}"'
+
+    def log_message(self, format: str, *args) -> None:
+        self.server.logger.debug(f"{self.address_string()} {format % args}")
+
+
+class MirrorServer(ThreadingHTTPServer):
+    def __init__(
+        self,
+        address: tuple[str, int],
+        versions: dict[HardwareType, dict],
+        cache: FirmwareCache | None = None,
+        logger=None,
+    ) -> None:
+        """HTTP server exposing the firmware cache to other codexctl instances
+
+        Firmware is served at `/<version file id>`, so `http://<host>:<port>/REPLACE_ID`
+        can be used as an external provider URL.
+
+        Args:
+            address (tuple[str, int]): Host and port to listen on
+            versions (dict[HardwareType, dict]): Versions of each device type, as in version-ids.json
+            cache (FirmwareCache, optional): Cache to serve. Defaults to the default firmware cache.
+            logger (logger, optional): Logger object for logging. Defaults to None.
+        """
+        self.logger = logger
+        self.cache = cache
+
+        if self.logger is None:
+            self.logger = logging
+
+        if self.cache is None:
+            self.cache = FirmwareCache(logger=self.logger)
+
+        self.checksums = {
+            file_id: checksum
+            for hardware_versions in versions.values()
+            for file_id, checksum in hardware_versions.values()
+        }
+
+        super().__init__(address, MirrorRequestHandler)
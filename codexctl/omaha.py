@@ -0,0 +1,434 @@
+import asyncio
+import email.utils
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+from http import HTTPStatus
+from typing import NamedTuple
+
+from .fileserver import SOCKET_BUFFER_SIZE, file_response
+from .metrics import OPENMETRICS_CONTENT_TYPE, UpdateMetrics
+from .server import PayloadHashes, UpdateRoutes, response_ok
+
+MAX_HEADER_SIZE = 64 * 1024  # Largest request head accepted
+LISTEN_BACKLOG = 1024  # Devices connecting at once
+KEEP_ALIVE_TIMEOUT = 300  # Seconds an idle connection is kept open
+EVENT_DOWNLOAD_FINISHED = 14  # Omaha eventtype sent once the payload is downloaded and verified
+TRANSFER_CHUNK_SIZE = 16 * 1024 * 1024  # Bytes sent between progress updates of a payload transfer
+
+
+class UpdateEvent(NamedTuple):
+    """An Omaha event reported by a device"""
+
+    machine_id: str | None
+    boot_id: str | None
+    address: str
+    event_type: int
+    result: int
+    error_code: str | None
+
+    @property
+    def success(self) -> bool:
+        return self.result != 0
+
+    @property
+    def finished(self) -> bool:
+        """Whether the update finished, either by downloading the payload or by failing"""
+        return self.event_type == EVENT_DOWNLOAD_FINISHED or not self.success
+
+    def matches(self, device: str | None) -> bool:
+        """Whether the event was sent by a device, given by machine id, boot id or IP address (None for any device)"""
+        return device is None or device in (self.machine_id, self.boot_id, self.address)
+
+
+class AsyncUpdateServer(UpdateRoutes):
+    def __init__(
+        self,
+        address: tuple[str, int],
+        versions: dict,
+        host_url: str | None = None,
+        folder: str = "updates",
+        hashes: PayloadHashes | None = None,
+        metrics: UpdateMetrics | None = None,
+        logger=None,
+    ) -> None:
+        """Fake Omaha update server built on asyncio
+
+        Serves the Omaha protocol of the old update engine. Every connection is a
+        coroutine, so thousands of idle keep-alive connections are cheap and
+        payloads are sent with sendfile, paced by the client's receive window.
+        Events finishing an update can be awaited with `wait_for_completion`,
+        and per device transfer figures are served at `/metrics`.
+
+        Args:
+            address (tuple[str, int]): Host and port to listen on
+            versions (dict): Platform mapped to the (version, file name) served to it, as returned by `scanUpdates`
+            host_url (str, optional): URL devices reach this server at. Defaults to the listening address.
+            folder (str, optional): Folder containing the update files. Defaults to "updates".
+            hashes (PayloadHashes, optional): Digest cache of the update files. Defaults to a new `PayloadHashes`.
+            metrics (UpdateMetrics, optional): Accounting of the devices served. Defaults to a new `UpdateMetrics`.
+            logger (logger, optional): Logger object for logging. Defaults to None.
+        """
+        if logger is None:
+            logger = logging
+
+        if hashes is None:
+            hashes = PayloadHashes(logger=logger)
+
+        if metrics is None:
+            metrics = UpdateMetrics(logger=logger)
+
+        super().__init__(versions, host_url, folder, hashes, metrics)
+
+        self.address = address
+        self.logger = logger
+        self.server_address = None
+        self.loop = None
+        self.events = []
+        self.waiters = []
+
+        self.__server = None
+
+    async def start(self) -> None:
+        """Starts listening for connections
+
+        Raises:
+            OSError: If the address can't be bound
+        """
+        self.loop = asyncio.get_running_loop()
+        self.__server = await asyncio.start_server(
+            self.__handle, *self.address, limit=MAX_HEADER_SIZE, backlog=LISTEN_BACKLOG
+        )
+        self.server_address = self.__server.sockets[0].getsockname()[:2]
+
+        if self.host_url is None:
+            self.host_url = f"http://{self.address[0]}:{self.server_address[1]}/"
+
+        self.logger.debug(f"Fake updater listening on {self.server_address}")
+
+    async def serve_forever(self) -> None:
+        if self.__server is None:
+            await self.start()
+
+        await self.__server.serve_forever()
+
+    async def close(self) -> None:
+        self.__server.close()
+        await self.__server.wait_closed()
+
+    def start_thread(self) -> threading.Thread:
+        """Runs the server on an event loop in a daemon thread, returning once it is listening
+
+        Returns:
+            threading.Thread: Thread running the event loop
+
+        Raises:
+            OSError: If the address can't be bound
+        """
+        started = threading.Event()
+        error = None
+
+        async def run() -> None:
+            nonlocal error
+            try:
+                await self.start()
+            except OSError as e:
+                error = e
+                return
+            finally:
+                started.set()
+
+            await self.serve_forever()
+
+        thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+        thread.start()
+        started.wait()
+
+        if error is not None:
+            raise error
+
+        return thread
+
+    async def wait_for_completion(
+        self, device: str | None = None, timeout: float | None = None
+    ) -> UpdateEvent:
+        """Waits for a device to finish its update
+
+        Args:
+            device (str, optional): Machine id, boot id or IP address of the device. Defaults to any device.
+            timeout (float, optional): Seconds to wait. Defaults to waiting forever.
+
+        Returns:
+            UpdateEvent: Event that finished the update, check `success` for the outcome
+
+        Raises:
+            TimeoutError: If the update didn't finish in time
+        """
+        for event in self.events:
+            if event.finished and event.matches(device):
+                return event
+
+        waiter = (device, self.loop.create_future())
+        self.waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter[1], timeout)
+        finally:
+            self.waiters.remove(waiter)
+
+    def completion(self, device: str | None = None, timeout: float | None = None) -> UpdateEvent:
+        """Waits for a device to finish its update from another thread, see `wait_for_completion`"""
+        return asyncio.run_coroutine_threadsafe(
+            self.wait_for_completion(device, timeout), self.loop
+        ).result()
+
+    def record_event(self, event: UpdateEvent) -> None:
+        """Records an event sent by a device, waking anything waiting for it to finish"""
+        self.events.append(event)
+        self.metrics.event(
+            event.address,
+            event.machine_id,
+            event.event_type,
+            event.result,
+            event.error_code,
+            event.finished,
+        )
+
+        if not event.success:
+            self.logger.error(
+                f"Device {event.machine_id or event.address} reported an error in event {event.event_type}: {event.error_code}"
+            )
+
+        if not event.finished:
+            return
+
+        for device, future in self.waiters:
+            if event.matches(device) and not future.done():
+                future.set_result(event)
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
+        address = writer.get_extra_info("peername")[0]
+
+        try:
+            while await self.__handle_request(reader, writer, address):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def __handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address: str
+    ) -> bool:
+        """Handles one request of a connection, returning whether the connection should be kept open"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return False
+        except asyncio.LimitOverrunError:
+            await self.__send(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, keep_alive=False)
+            return False
+
+        received = time.monotonic()
+        request_line, *header_lines = head.decode("latin-1").split("\r\n")[:-2]
+        try:
+            method, path, protocol = request_line.split(" ")
+        except ValueError:
+            await self.__send(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return False
+
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        keep_alive = (
+            connection != "close"
+            if protocol == "HTTP/1.1"
+            else connection == "keep-alive"
+        )
+
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        match method:
+            case "POST":
+                response = await self.__omaha(body, address, received)
+                if response is None:
+                    await self.__send(writer, HTTPStatus.BAD_REQUEST, keep_alive=keep_alive)
+                else:
+                    await self.__send(
+                        writer,
+                        HTTPStatus.OK,
+                        {"Content-Type": "text/xml"},
+                        response.encode(),
+                        keep_alive,
+                    )
+            case "GET" if path.split("?")[0] == "/metrics":
+                await self.__send(
+                    writer,
+                    HTTPStatus.OK,
+                    {"Content-Type": OPENMETRICS_CONTENT_TYPE},
+                    self.metrics.render().encode(),
+                    keep_alive,
+                )
+            case "GET" | "HEAD":
+                await self.__send_file(
+                    writer, path, headers, keep_alive, method == "HEAD", address, received
+                )
+            case _:
+                await self.__send(writer, HTTPStatus.METHOD_NOT_ALLOWED, keep_alive=keep_alive)
+
+        return keep_alive
+
+    async def __omaha(self, body: bytes, address: str, received: float) -> str | None:
+        """Handles an Omaha request, returning the response XML or None if the request is invalid"""
+        try:
+            xml = ET.fromstring(body)
+        except ET.ParseError:
+            return None
+
+        app = xml.find("app")
+        if app is None or xml.find("os") is None:
+            return None
+
+        if app.find("updatecheck") is not None:
+            self.logger.debug(
+                f"Update check from {address} on {xml.attrib.get('version')} ({xml.find('os').get('platform')})"
+            )
+            # Hashing a new payload takes a while, so keep it off the event loop
+            response = await self.loop.run_in_executor(
+                None, self.updatecheck_response, xml, address
+            )
+            self.metrics.updatecheck(
+                address,
+                app.get("machineid", "").strip("{}") or None,
+                xml.get("version"),
+                time.monotonic() - received,
+            )
+            return response
+
+        event_node = app.find("event")
+        if event_node is not None:
+            try:
+                event = UpdateEvent(
+                    app.get("machineid", "").strip("{}") or None,
+                    app.get("bootid", "").strip("{}") or None,
+                    address,
+                    int(event_node.attrib["eventtype"]),
+                    int(event_node.attrib["eventresult"]),
+                    event_node.get("errorcode"),
+                )
+            except (KeyError, ValueError):
+                return None
+
+            self.record_event(event)
+
+        return response_ok
+
+    async def __send_file(
+        self,
+        writer: asyncio.StreamWriter,
+        path: str,
+        headers: dict[str, str],
+        keep_alive: bool,
+        head: bool,
+        address: str,
+        received: float,
+    ) -> None:
+        """Sends a payload from the update folder, or the byte range of it that was requested"""
+        name = urllib.parse.unquote(path.split("?")[0]).lstrip("/")
+        location = os.path.join(self.folder, os.path.basename(name))
+        if os.path.dirname(name) != "updates" or not os.path.isfile(location):
+            await self.__send(writer, HTTPStatus.NOT_FOUND, keep_alive=keep_alive)
+            return
+
+        with open(location, "rb") as f:
+            status, response_headers, offset, length = file_response(
+                os.fstat(f.fileno()), None, headers.get("range"), headers.get("if-range")
+            )
+
+            self.__write_head(writer, status, response_headers, keep_alive)
+            await writer.drain()
+
+            if not head and length:
+                await self.__transfer(writer, f, offset, length, address, received)
+
+    async def __transfer(
+        self,
+        writer: asyncio.StreamWriter,
+        f,
+        offset: int,
+        length: int,
+        address: str,
+        received: float,
+    ) -> None:
+        """Sends part of a payload, accounting for it in the metrics as it goes"""
+        name = os.path.basename(f.name)
+        started = time.monotonic()
+        self.metrics.start_transfer(address, name, offset, length, started - received)
+
+        sent = 0
+        try:
+            while sent < length:
+                chunk_started = time.monotonic()
+                f.seek(offset + sent)
+                try:
+                    # sendfile waits for the socket to be writable, so a slow client only holds its own coroutine
+                    await self.loop.sendfile(
+                        writer.transport, f, offset + sent, min(TRANSFER_CHUNK_SIZE, length - sent)
+                    )
+                finally:
+                    # sendfile moves the file position even when the device disconnects part way through a chunk
+                    count = f.tell() - offset - sent
+                    self.metrics.add_bytes(address, count, time.monotonic() - chunk_started)
+                    sent += count
+
+                if count == 0:  # The file was truncated
+                    break
+        finally:
+            self.metrics.finish_transfer(
+                address, name, sent, time.monotonic() - started, sent == length
+            )
+
+    async def __send(
+        self,
+        writer: asyncio.StreamWriter,
+        status: HTTPStatus,
+        headers: dict[str, str] | None = None,
+        body: bytes = b"",
+        keep_alive: bool = True,
+    ) -> None:
+        self.__write_head(
+            writer, status, (headers or {}) | {"Content-Length": str(len(body))}, keep_alive
+        )
+        writer.write(body)
+        await writer.drain()
+
+    @staticmethod
+    def __write_head(
+        writer: asyncio.StreamWriter,
+        status: HTTPStatus,
+        headers: dict[str, str],
+        keep_alive: bool,
+    ) -> None:
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Date: {email.utils.formatdate(usegmt=True)}",
+            "Server: codexctl",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
@@ -0,0 +1,366 @@
+import hashlib
+import io
+import logging
+import threading
+
+from collections import OrderedDict
+
+import requests
+
+from .download import PROBE_TIMEOUT, STALL_TIMEOUT, supports_ranges
+from .session import create_session
+
+BLOCK_SIZE = 256 * 1024  # Bytes fetched per range request
+CACHE_BLOCKS = 256  # Blocks kept in memory (64 MiB)
+
+CPIO_MAGIC = (b"070701", b"070702")  # newc, and newc with checksums
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = "TRAILER!!!"
+
+
+class HTTPRangeFile(io.RawIOBase):
+    def __init__(
+        self,
+        uri: str,
+        session: requests.Session | None = None,
+        size: int | None = None,
+        block_size: int = BLOCK_SIZE,
+        cache_blocks: int = CACHE_BLOCKS,
+        logger=None,
+    ) -> None:
+        """Read only file object backed by HTTP range requests
+
+        Reads are served from fixed size blocks, which are fetched on demand and
+        kept in an LRU cache. Runs of missing blocks are fetched in one request.
+
+        Args:
+            uri (str): Location of the file
+            session (requests.Session, optional): Session to make requests with. Defaults to a new session.
+            size (int, optional): Size of the file, if already known. Defaults to asking the server.
+            block_size (int, optional): Bytes fetched per block. Defaults to BLOCK_SIZE.
+            cache_blocks (int, optional): Number of blocks kept in memory. Defaults to CACHE_BLOCKS.
+            logger (logger, optional): Logger object for logging. Defaults to None.
+
+        Raises:
+            OSError: If the server can't be reached or doesn't support range requests
+        """
+        super().__init__()
+
+        self.uri = uri
+        self.session = session
+        self.size = size
+        self.block_size = block_size
+        self.cache_blocks = max(cache_blocks, 2)
+        self.logger = logger
+        self.position = 0
+        self.bytes_fetched = 0
+        self.requests = 0
+
+        self.__blocks = OrderedDict()
+        self.__lock = threading.Lock()
+
+        if self.logger is None:
+            self.logger = logging
+
+        if self.session is None:
+            self.session = create_session()
+
+        if self.size is None:
+            try:
+                response = self.session.head(
+                    uri, allow_redirects=True, timeout=PROBE_TIMEOUT
+                )
+            except requests.exceptions.RequestException as error:
+                raise OSError(f"Could not reach {uri}: {error}") from error
+
+            if response.status_code != 200:
+                raise OSError(f"{uri} responded with {response.status_code}")
+
+            if not supports_ranges(response):
+                raise OSError(f"{uri} does not support range requests")
+
+            if not response.headers.get("content-length", "").isdigit():
+                raise OSError(f"{uri} did not report its size")
+
+            self.size = int(response.headers["content-length"])
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                self.position = offset
+            case io.SEEK_CUR:
+                self.position += offset
+            case io.SEEK_END:
+                self.position = self.size + offset
+            case _:
+                raise ValueError(f"Invalid whence {whence}")
+
+        if self.position < 0:
+            raise OSError("Negative seek position")
+
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        length = max(min(len(view), self.size - self.position), 0)
+
+        written = 0
+        while written < length:
+            offset = self.position + written
+            index = offset // self.block_size
+            block = self.__block(index, (offset + length - written - 1) // self.block_size)
+
+            start = offset - index * self.block_size
+            count = min(len(block) - start, length - written)
+            view[written : written + count] = block[start : start + count]
+            written += count
+
+        self.position += written
+        return written
+
+    def __block(self, index: int, last: int) -> bytes:
+        """Gets a block, fetching it (and the missing blocks after it up to `last`) if needed"""
+        with self.__lock:
+            if index in self.__blocks:
+                self.__blocks.move_to_end(index)
+                return self.__blocks[index]
+
+            # Fetch the run of missing blocks in one request, leaving room in the cache
+            end = index
+            while (
+                end < last
+                and end + 1 not in self.__blocks
+                and end + 1 - index < self.cache_blocks // 2
+            ):
+                end += 1
+
+            data = self.__fetch(
+                index * self.block_size,
+                min((end + 1) * self.block_size, self.size) - 1,
+            )
+            for i in range(index, end + 1):
+                offset = (i - index) * self.block_size
+                self.__blocks[i] = data[offset : offset + self.block_size]
+
+            while len(self.__blocks) > self.cache_blocks:
+                self.__blocks.popitem(last=False)
+
+            return self.__blocks[index]
+
+    def __fetch(self, start: int, end: int) -> bytes:
+        """Fetches an inclusive byte range of the file"""
+        self.logger.debug(f"Fetching bytes {start}-{end} of {self.uri}")
+        try:
+            response = self.session.get(
+                self.uri,
+                headers={"Range": f"bytes={start}-{end}"},
+                timeout=(PROBE_TIMEOUT, STALL_TIMEOUT),
+            )
+        except requests.exceptions.RequestException as error:
+            raise OSError(f"Failed to read {self.uri}: {error}") from error
+
+        if response.status_code != 206:
+            raise OSError(
+                f"{self.uri} responded with {response.status_code} to a range request"
+            )
+
+        if len(response.content) != end - start + 1:
+            raise OSError(f"{self.uri} returned a short range")
+
+        self.requests += 1
+        self.bytes_fetched += len(response.content)
+        return response.content
+
+
+class FileSlice(io.RawIOBase):
+    def __init__(self, file, offset: int, size: int) -> None:
+        """Read only view of part of a seekable file, such as a member of an archive
+
+        Args:
+            file (file object): Seekable binary file
+            offset (int): Start of the view in the file
+            size (int): Size of the view
+        """
+        super().__init__()
+
+        self.file = file
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                self.position = offset
+            case io.SEEK_CUR:
+                self.position += offset
+            case io.SEEK_END:
+                self.position = self.size + offset
+            case _:
+                raise ValueError(f"Invalid whence {whence}")
+
+        if self.position < 0:
+            raise OSError("Negative seek position")
+
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        length = max(min(len(view), self.size - self.position), 0)
+
+        self.file.seek(self.offset + self.position)
+        data = self.file.read(length)
+        view[: len(data)] = data
+
+        self.position += len(data)
+        return len(data)
+
+
+class CPIOArchive:
+    def __init__(self, file) -> None:
+        """Reads members of a newc CPIO archive (such as a SWU update) from a seekable file
+
+        Only the member headers are read when the archive is opened, so with a
+        `HTTPRangeFile` a member can be read without fetching the rest of the archive.
+
+        Args:
+            file (file object): Seekable binary file containing the archive
+
+        Raises:
+            ValueError: If the file isn't a newc CPIO archive
+        """
+        self.file = file
+        self.members = {}
+        self.__checksums = None
+
+        position = 0
+        while True:
+            self.file.seek(position)
+            header = self.file.read(CPIO_HEADER_SIZE)
+            if len(header) != CPIO_HEADER_SIZE or header[:6] not in CPIO_MAGIC:
+                raise ValueError(f"Invalid CPIO header at offset {position}")
+
+            size = int(header[54:62], 16)
+            name_size = int(header[94:102], 16)
+            name = self.file.read(name_size)[:-1].decode()
+
+            if name == CPIO_TRAILER:
+                break
+
+            offset = self.__align(position + CPIO_HEADER_SIZE + name_size)
+            self.members[name] = (offset, size)
+            position = self.__align(offset + size)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.members
+
+    def open(self, name: str) -> FileSlice:
+        """Opens a member of the archive without reading it
+
+        Args:
+            name (str): Name of the member
+
+        Returns:
+            FileSlice: Seekable view of the member
+
+        Raises:
+            KeyError: If the member isn't in the archive
+        """
+        offset, size = self.members[name]
+        return FileSlice(self.file, offset, size)
+
+    def read(self, name: str) -> bytes:
+        """Reads a member of the archive
+
+        Args:
+            name (str): Name of the member
+
+        Returns:
+            bytes: Contents of the member
+
+        Raises:
+            KeyError: If the member isn't in the archive
+        """
+        offset, size = self.members[name]
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def checksums(self) -> dict[str, str]:
+        """Gets the sha256 of every member listed in the archive's sw-description
+
+        Returns:
+            dict[str, str]: Member names mapped to their sha256
+        """
+        import libconf
+
+        if self.__checksums is not None:
+            return self.__checksums
+
+        checksums = {}
+        if "sw-description" not in self:
+            return checksums
+
+        def collect(value) -> None:
+            if isinstance(value, dict):
+                if "filename" in value and "sha256" in value:
+                    checksums[value["filename"]] = value["sha256"]
+
+                for item in value.values():
+                    collect(item)
+
+            elif isinstance(value, (list, tuple)):
+                for item in value:
+                    collect(item)
+
+        collect(libconf.loads(self.read("sw-description").decode()))
+        self.__checksums = checksums
+        return checksums
+
+    def read_verified(self, name: str) -> bytes:
+        """Reads a member, checking it against the sha256 listed in sw-description
+
+        sw-description.sig isn't checked, so this catches a corrupt transfer but
+        not a modified archive. Don't use it for anything that gets flashed.
+
+        Args:
+            name (str): Name of the member
+
+        Returns:
+            bytes: Contents of the member
+
+        Raises:
+            KeyError: If the member isn't in the archive
+            ValueError: If sw-description lists no sha256 for the member, or the member doesn't match it
+        """
+        checksum = self.checksums().get(name)
+        if checksum is None:
+            raise ValueError(f"sw-description lists no sha256 for {name}")
+
+        data = self.read(name)
+        if hashlib.sha256(data).hexdigest() != checksum:
+            raise ValueError(f"{name} does not match the sha256 in sw-description")
+
+        return data
+
+    @staticmethod
+    def __align(offset: int) -> int:
+        """Rounds an offset up to the 4 byte alignment used by newc archives"""
+        return (offset + 3) & ~3
@@ -1,8 +1,16 @@
-from http.server import HTTPServer, SimpleHTTPRequestHandler
 import xml.etree.ElementTree as ET
 import os
 import hashlib
 import binascii
+import json
+import logging
+import threading
+import time
+
+from .versions import parse_version
+
+BUF_SIZE = 1024 * 1024  # Bytes hashed at a time
+MTIME_GRANULARITY = 2 * 10**9  # Nanoseconds, coarse enough for any filesystem
 
 response_ok = """<?xml version='1.0' encoding='UTF-8'?>
 <response protocol="3.0" server="prod">
@@ -14,6 +22,16 @@ response_ok = """<?xml version='1.0' encoding='UTF-8'?>
 </response>
 """
 
+response_noupdate = """<?xml version="1.0" encoding="UTF-8"?>
+<response protocol="3.0" server="prod">
+	<daystart elapsed_seconds="37145" elapsed_days="5179"/>
+	<app status="ok" appid="{98DA7DF2-4E3E-4744-9DE6-EC931886ABAB}">
+		<updatecheck status="noupdate"/>
+		<ping status="ok"/>
+	</app>
+</response>
+"""
+
 response_template = """<?xml version="1.0" encoding="UTF-8"?>
  <response protocol="3.0" server="prod">
 	<daystart elapsed_seconds="37145" elapsed_days="5179"/>
@@ -38,135 +56,391 @@ response_template = """<?xml version="1.0" encoding="UTF-8"?>
 """
 
 
-def getupdateinfo(platform, version, update_name):
-    full_path = os.path.join("updates", update_name)
+class PayloadHashes:
+    def __init__(self, location: str | None = None, logger=None) -> None:
+        """Digests of update payloads, kept in a sidecar file so each payload is only hashed once
 
-    update_size = str(os.path.getsize(full_path))
+        Entries are keyed by the payload's path, size, mtime and inode, so a
+        changed or replaced file is hashed again.
 
-    BUF_SIZE = 8192
+        Args:
+            location (str, optional): Location of the sidecar file. Defaults to payload-hashes.json in the cache folder.
+            logger (logger, optional): Logger object for logging. Defaults to None.
+        """
+        self.logger = logger
 
-    sha1 = hashlib.sha1()
-    sha256 = hashlib.sha256()
-    with open(full_path, "rb") as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            sha1.update(data)
-            sha256.update(data)
-    update_sha1 = binascii.b2a_base64(sha1.digest(), newline=False).decode()
-    update_sha256 = binascii.b2a_base64(sha256.digest(), newline=False).decode()
-    return (update_sha1, update_sha256, update_size)
+        if self.logger is None:
+            self.logger = logging
 
+        if location is None:
+            from .cache import get_cache_folder
 
-def get_available_version(version):
-    available_versions = scanUpdates()
-
-    for device, ids in available_versions.items():
-        if version in ids:
-            available_version = {device: ids}
+            location = os.path.join(get_cache_folder(), "payload-hashes.json")
 
-            return available_version
-
-
-def scanUpdates():
-    files = os.listdir("updates")
-    versions = {}
+        self.location = location
+        self.lock = threading.Lock()
+        self.hashing = {}
+
+    def get(self, path: str) -> tuple[str, str, str]:
+        """Gets the digests of a payload, hashing it if they aren't known yet
 
-    for f in files:
-        p = f.split("_")
+        Args:
+            path (str): Location of the payload
+
+        Returns:
+            tuple[str, str, str]: Base64 sha1, base64 sha256 and size of the payload
+        """
+        path = os.path.abspath(path)
+
+        with self.lock:
+            entry = self.__entry(path)
+            if entry is None or "sha1" not in entry:
+                # Only one thread hashes a payload, the others wait for it
+                hashing = self.hashing.setdefault(path, threading.Lock())
+
+        if entry is not None and "sha1" in entry:
+            return entry["sha1"], entry["sha256"], str(entry["size"])
+
+        with hashing:
+            with self.lock:
+                entry = self.__entry(path) or {}
+
+            if "sha1" not in entry:
+                sha1 = hashlib.sha1()
+                sha256 = None if "sha256" in entry else hashlib.sha256()
+                with open(path, "rb") as f:
+                    stat = os.fstat(f.fileno())
+                    while data := f.read(BUF_SIZE):
+                        sha1.update(data)
+                        if sha256 is not None:
+                            sha256.update(data)
+
+                entry["sha1"] = binascii.b2a_base64(sha1.digest(), newline=False).decode()
+                if sha256 is not None:
+                    entry["sha256"] = binascii.b2a_base64(
+                        sha256.digest(), newline=False
+                    ).decode()
+
+                with self.lock:
+                    self.__store(path, stat, entry)
+
+        return entry["sha1"], entry["sha256"], str(os.path.getsize(path))
+
+    def remember(self, path: str, sha256: str) -> None:
+        """Records an already known sha256 of a payload (e.g. from version-ids.json), so only its sha1 is computed
+
+        Args:
+            path (str): Location of the payload
+            sha256 (str): Hex sha256 of the payload
+        """
+        path = os.path.abspath(path)
+        entry = {
+            "sha256": binascii.b2a_base64(bytes.fromhex(sha256), newline=False).decode()
+        }
+
+        with self.lock:
+            if self.__entry(path) is None:
+                self.__store(path, os.stat(path), entry)
+
+    def prepare(self, paths: list[str]) -> threading.Thread:
+        """Hashes payloads in the background, so they are ready when a device asks for them
+
+        Args:
+            paths (list[str]): Location of each payload
+
+        Returns:
+            threading.Thread: Thread doing the hashing
+        """
+
+        def prepare_all() -> None:
+            for path in paths:
+                try:
+                    self.get(path)
+                except OSError as error:
+                    self.logger.error(f"Could not hash {path}: {error}")
+
+        thread = threading.Thread(target=prepare_all, daemon=True)
+        thread.start()
+
+        return thread
+
+    def __entry(self, path: str) -> dict | None:
+        """Gets the stored entry of a payload, None if there is none or the file changed"""
+        entry = self.__load().get(path)
+        if entry is None:
+            return None
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        if (entry["size"], entry["mtime"], entry["inode"]) != (
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+        ):
+            return None
+
+        return entry
+
+    def __store(self, path: str, stat: os.stat_result, entry: dict) -> None:
+        """Stores the entry of a payload, dropping entries of files that no longer exist"""
+        entries = {
+            location: value
+            for location, value in self.__load().items()
+            if os.path.exists(location)
+        }
+        entries[path] = entry | {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "inode": stat.st_ino,
+        }
+
+        os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        with open(f"{self.location}.tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(f"{self.location}.tmp", self.location)
+
+    def __load(self) -> dict:
+        try:
+            with open(self.location) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+class UpdateIndex:
+    def __init__(self, folder: str = "updates") -> None:
+        """Index of the update payloads in a folder, such as `3.5.2.1807_reMarkable2-abc.signed`
+
+        The folder is only listed again when its mtime changes, and then only
+        new file names are parsed, so lookups stay cheap with many payloads.
+
+        Args:
+            folder (str, optional): Folder containing the payloads. Defaults to "updates".
+        """
+        self.folder = os.path.abspath(folder)
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.entries = {}  # File name -> (product, version, key)
+        self.by_version = {}  # Version or file name -> {product: (version, file name)}
+        self.latest = {}  # Product -> (version, file name)
+
+    def refresh(self) -> None:
+        """Updates the index if files were added, removed or renamed"""
+        with self.lock:
+            try:
+                mtime = os.stat(self.folder).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+
+            if mtime is not None and mtime == self.mtime:
+                return
+
+            names = set(os.listdir(self.folder)) if mtime is not None else set()
+            changed = set(self.entries) ^ names
+            for name in changed:
+                if name in self.entries:
+                    del self.entries[name]
+                elif (entry := self.__parse(name)) is not None:
+                    self.entries[name] = entry
+
+            if changed:
+                self.__rebuild()
+
+            # A change within the mtime granularity wouldn't change the mtime, so
+            # keep listing a recently modified folder until it settles
+            if mtime is not None and time.time_ns() - mtime < MTIME_GRANULARITY:
+                mtime = None
+
+            self.mtime = mtime
+
+    def versions(self) -> dict[str, tuple[str, str]]:
+        """Gets the newest payload of each product
+
+        Returns:
+            dict[str, tuple[str, str]]: Product mapped to the version and file name of its newest payload
+        """
+        self.refresh()
+        return dict(self.latest)
+
+    def get(self, version: str) -> dict[str, tuple[str, str]] | None:
+        """Gets the payloads of a version
+
+        Args:
+            version (str): Version id or file name of the payload
+
+        Returns:
+            dict[str, tuple[str, str]] | None: Product mapped to the version and file name of the payload, None if there is none
+        """
+        self.refresh()
+        available = self.by_version.get(version)
+        return dict(available) if available else None
+
+    def __rebuild(self) -> None:
+        by_version = {}
+        latest = {}
+        newest = {}
+        for name, (product, version, key) in self.entries.items():
+            by_version.setdefault(version, {})[product] = (version, name)
+            by_version[name] = {product: (version, name)}
+
+            if product not in newest or newest[product] < key:
+                newest[product] = key
+                latest[product] = (version, name)
+
+        self.by_version = by_version
+        self.latest = latest
+
+    @staticmethod
+    def __parse(name: str) -> tuple[str, str, tuple[int, ...]] | None:
+        """Parses a payload file name, None if it isn't one"""
+        p = name.split("_")
         if len(p) != 2:
-            continue
+            return None
         t = p[1].split(".")
         if len(t) != 2:
-            continue
-
-        z = t[0].split("-")
+            return None
 
         version = p[0]
-        # print(version)
-        product = z[0]
-
-        if product not in versions or versions[product][0] < version:
-            versions[product] = (version, f)
-
-    return versions
-
-
-class MySimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
-    def do_POST(self):
-        length = int(self.headers.get("Content-Length"))
-        body = self.rfile.read(length).decode("utf-8")
-        # print(body)
-        print("Updating...")
-        xml = ET.fromstring(body)
-        updatecheck_node = xml.find("app/updatecheck")
-
-        # check for update
-        if updatecheck_node is not None:
-            version = xml.attrib["version"]
-            platform = xml.find("os").attrib["platform"]
-            print("requested: ", version)
-            print("platform: ", platform)
-
-            version, update_name = available_versions[platform]
-
-            update_sha1, update_sha256, update_size = getupdateinfo(
-                platform, version, update_name
-            )
-            params = {
-                "version": version,
-                "update_name": f"updates/{update_name}",
-                "update_sha1": update_sha1,
-                "update_sha256": update_sha256,
-                "update_size": update_size,
-                "codebase_url": host_url,
-            }
-
-            response = response_template.format(**params)
-            # print("Response:")
-            # print(response)
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(response.encode())
-            return
-
-        event_node = xml.find("app/event")
-        event_type = int(event_node.attrib["eventtype"])
-        event_result = int(event_node.attrib["eventresult"])
-
-        # post install status
-        if event_result != 0:
-            print("Update downloaded, please wait for device to install...")
-            if "errorcode" in event_node.attrib:
-                print("With errorcode:", event_node.attrib["errorcode"])
-            return
-
-        # update done
-        if event_type == 14:
-            print("OK Response:")
-            print(response_ok)
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(response_ok.encode())
-            return
-
-
-def startUpdate(versionsGiven, host, port=8080):
-    global available_versions
-    global host_url  # I am aware globals are generally bad practice, but this is a quick and dirty solution
-
-    host_url = f"http://{host}:{port}/"
-    available_versions = versionsGiven
-
-    if not available_versions:
-        raise FileNotFoundError("Could not find any update files")
-
-    handler = MySimpleHTTPRequestHandler
-    print(f"Starting fake updater at {host}:{port}")
-    try:
-        httpd = HTTPServer((host, port), handler)
-    except OSError:
-        print("Error: Could not start fake updater. Is the port already in use?")
-        return
-    httpd.serve_forever()
+        product = t[0].split("-")[0]
+
+        try:
+            return product, version, parse_version(version)
+        except ValueError:
+            return None
+
+
+update_indexes = {}
+
+
+def get_update_index(folder: str = "updates") -> UpdateIndex:
+    """Gets the shared index of an update folder, creating it on first use"""
+    folder = os.path.abspath(folder)
+    if folder not in update_indexes:
+        update_indexes[folder] = UpdateIndex(folder)
+
+    return update_indexes[folder]
+
+
+def get_available_version(version):
+    return get_update_index().get(version)
+
+
+def scanUpdates():
+    return get_update_index().versions()
+
+
+class UpdateRoutes:
+    def __init__(
+        self,
+        versions: dict,
+        host_url: str | None = None,
+        folder: str = "updates",
+        hashes: PayloadHashes | None = None,
+        metrics=None,
+    ) -> None:
+        """Versions served by a fake Omaha update server, and the devices routed to other versions
+
+        Every device gets the version for its platform from `versions`, unless
+        it has been routed to another version with `route`.
+
+        Args:
+            versions (dict): Platform mapped to the (version, file name) served to it, as returned by `scanUpdates`
+            host_url (str, optional): URL devices reach the server at. Defaults to None.
+            folder (str, optional): Folder containing the update files. Defaults to "updates".
+            hashes (PayloadHashes, optional): Digest cache of the update files. Defaults to a new `PayloadHashes`.
+            metrics (UpdateMetrics, optional): Accounting of the devices served. Defaults to a new `UpdateMetrics`.
+        """
+        self.versions = dict(versions)
+        self.folder = folder
+        self.hashes = hashes
+        self.metrics = metrics
+        self.host_url = host_url
+        self.routes = {}
+        self.routes_lock = threading.Lock()
+
+        if self.hashes is None:
+            self.hashes = PayloadHashes()
+
+        if self.metrics is None:
+            from .metrics import UpdateMetrics
+
+            self.metrics = UpdateMetrics()
+
+    def route(self, device: str, version: str, update_name: str) -> None:
+        """Serves a version to one device instead of the default for its platform
+
+        Args:
+            device (str): Machine id, boot id or IP address of the device
+            version (str): Version to serve
+            update_name (str): File name of the version in the update folder
+        """
+        with self.routes_lock:
+            self.routes[device] = (version, update_name)
+
+        self.hashes.prepare([os.path.join(self.folder, update_name)])
+
+    def unroute(self, device: str) -> None:
+        """Serves a device the default version for its platform again"""
+        with self.routes_lock:
+            self.routes.pop(device, None)
+
+    def target_for(self, xml: ET.Element, address: str, platform: str) -> tuple[str, str] | None:
+        """Gets the version to serve a device
+
+        Args:
+            xml (ET.Element): Request sent by the device
+            address (str): IP address of the device
+            platform (str): Platform of the device
+
+        Returns:
+            tuple[str, str] | None: Version and file name to serve, None if there is no update for the device
+        """
+        app = xml.find("app")
+        keys = [] if app is None else [app.get("machineid"), app.get("bootid")]
+
+        with self.routes_lock:
+            for key in keys + [address]:
+                if key is not None and key.strip("{}") in self.routes:
+                    return self.routes[key.strip("{}")]
+
+        return self.versions.get(platform)
+
+    def updatecheck_response(self, xml: ET.Element, address: str) -> str:
+        """Builds the response to an updatecheck request, hashing the payload if needed
+
+        Args:
+            xml (ET.Element): Request sent by the device
+            address (str): IP address of the device
+
+        Returns:
+            str: Response XML
+        """
+        target = self.target_for(xml, address, xml.find("os").attrib["platform"])
+        if target is None:
+            return response_noupdate
+
+        version, update_name = target
+
+        update_sha1, update_sha256, update_size = self.hashes.get(
+            os.path.join(self.folder, update_name)
+        )
+        params = {
+            "version": version,
+            "update_name": f"updates/{update_name}",
+            "update_sha1": update_sha1,
+            "update_sha256": update_sha256,
+            "update_size": update_size,
+            "codebase_url": self.host_url,
+        }
+
+        return response_template.format(**params)
+
+    def prepare(self) -> threading.Thread:
+        """Hashes the update files in the background, instead of on the first request for them"""
+        return self.hashes.prepare(
+            [os.path.join(self.folder, name) for _, name in self.versions.values()]
+        )
+
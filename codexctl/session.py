@@ -0,0 +1,60 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOL_SIZE = 16  # Connections kept alive per host
+RETRIES = 3  # Retries for failed connections and 429/5xx responses
+BACKOFF_FACTOR = 0.5  # Seconds, doubled after each retry
+
+
+def mount_adapters(
+    session: requests.Session,
+    pool_size: int = POOL_SIZE,
+    retries: int = RETRIES,
+    backoff_factor: float = BACKOFF_FACTOR,
+) -> None:
+    """Configures the connection pools and retry policy of a session
+
+    Only idempotent requests (GET, HEAD) are retried, so uploads are never sent twice.
+
+    Args:
+        session (requests.Session): Session to configure
+        pool_size (int, optional): Connections kept alive per host. Defaults to POOL_SIZE.
+        retries (int, optional): Number of retries. Defaults to RETRIES.
+        backoff_factor (float, optional): Backoff between retries in seconds. Defaults to BACKOFF_FACTOR.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def create_session(
+    pool_size: int = POOL_SIZE,
+    retries: int = RETRIES,
+    backoff_factor: float = BACKOFF_FACTOR,
+) -> requests.Session:
+    """Creates a session that keeps connections alive and shares them between requests
+
+    Args:
+        pool_size (int, optional): Connections kept alive per host. Defaults to POOL_SIZE.
+        retries (int, optional): Number of retries. Defaults to RETRIES.
+        backoff_factor (float, optional): Backoff between retries in seconds. Defaults to BACKOFF_FACTOR.
+
+    Returns:
+        requests.Session: Configured session
+    """
+    session = requests.Session()
+    mount_adapters(session, pool_size, retries, backoff_factor)
+
+    return session
@@ -3,16 +3,20 @@ import logging
 import os
 import time
 
-import requests
+from .session import create_session
 
 
 class RmWebInterfaceAPI:  # TODO: Add docstrings
-    def __init__(self, BASE="http://10.11.99.1/", logger=None):
+    def __init__(self, BASE="http://10.11.99.1/", logger=None, session=None):
         self.logger = logger
+        self.session = session
 
         if self.logger is None:
             self.logger = logging
 
+        if self.session is None:
+            self.session = create_session()
+
         self.BASE = BASE
         self.ID_ATTRIBUTE = "ID"
         self.NAME_ATTRIBUTE = "VissibleName"
@@ -27,9 +31,9 @@ class RmWebInterfaceAPI:  # TODO: Add docstrings
             )
 
             if fileUpload:
-                result = requests.post(self.BASE + endpoint, files=data)
+                result = self.session.post(self.BASE + endpoint, files=data)
             else:
-                result = requests.post(self.BASE + endpoint, data=data)
+                result = self.session.post(self.BASE + endpoint, data=data)
 
             if result.status_code == 408:
                 self.logger.error("Request timed out!")
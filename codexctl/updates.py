@@ -1,39 +1,148 @@
 import os
+import hashlib
 import requests
 import uuid
-import sys
 import json
-import hashlib
 import logging
+import threading
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
 
 from pathlib import Path
 from datetime import datetime
 
 import xml.etree.ElementTree as ET
 
+from .cache import FirmwareCache, MetadataCache
 from .device import HardwareType
+from .versions import (
+    BOOTLOADER_BOUNDARY,
+    NEW_UPDATE_ENGINE,
+    VersionIndex,
+    VersionRecord,
+    parse_version,
+)
+from .remote import HTTPRangeFile
+from .session import POOL_SIZE, create_session, mount_adapters
+from .download import (
+    DownloadState,
+    RangedDownload,
+    get_validator,
+    hash_file,
+    probe_mirrors,
+    stream_download,
+    supports_ranges,
+)
+
+VERSION_IDS_URL = (
+    "https://raw.githubusercontent.com/Jayy001/codexctl/main/data/version-ids.json"
+)
+TOLTEC_URL = "https://toltec-dev.org/stable/Compatibility"
+
+
+def generate_xml_data(
+    platform: str = "reMarkable2",
+    current: str = "3.2.3.1595",
+    machineid: str = "00".zfill(32),
+    bootid: str | None = None,
+    event: tuple[int, int] | None = None,
+) -> str:
+    """Generates the XML data of an Omaha request, as sent by the old update engine
+
+    Args:
+        platform (str, optional): Platform of the device. Defaults to "reMarkable2".
+        current (str, optional): Version the device is running. Defaults to "3.2.3.1595".
+        machineid (str, optional): Machine id of the device. Defaults to all zeros.
+        bootid (str, optional): Boot id of the device. Defaults to a random id.
+        event (tuple[int, int], optional): Event type and result to report instead of checking for an update. Defaults to None.
+
+    Returns:
+        str: XML data of the request
+    """
+    params = {
+        "installsource": "scheduler",
+        "requestid": str(uuid.uuid4()),
+        "sessionid": str(uuid.uuid4()),
+        "machineid": machineid,
+        "oem": "RM100-753-12345",
+        "appid": "98DA7DF2-4E3E-4744-9DE6-EC931886ABAB",
+        "bootid": bootid or str(uuid.uuid4()),
+        "current": current,
+        "group": "Prod",
+        "platform": platform,
+        "body": "<updatecheck/>",
+    }
+
+    if event is not None:
+        params["body"] = f'<event eventtype="{event[0]}" eventresult="{event[1]}"/>'
+
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<request protocol="3.0" version="{current}" requestid="{{{requestid}}}" sessionid="{{{sessionid}}}" updaterversion="0.4.2" installsource="{installsource}" ismachine="1">
+    <os version="zg" platform="{platform}" sp="{current}_armv7l" arch="armv7l"></os>
+    <app appid="{{{appid}}}" version="{current}" track="{group}" ap="{group}" bootid="{{{bootid}}}" oem="{oem}" oemversion="2.5.2" alephversion="{current}" machineid="{machineid}" lang="en-US" board="" hardware_class="" delta_okay="false" nextversion="" brand="" client="" >
+        {body}
+    </app>
+</request>""".format(**params)
 
 
 class UpdateManager:
-    def __init__(self, logger=None) -> None:
+    def __init__(self, logger=None, session: requests.Session | None = None) -> None:
         """Manager for downloading update versions
 
         Args:
             logger (logger, optional): Logger object for logging. Defaults to None.
+            session (requests.Session, optional): Session shared by every request, so connections are reused. Defaults to `create_session()`.
         """
 
         self.logger = logger
+        self.session = session
+        self.pool_size = POOL_SIZE
 
         if self.logger is None:
             self.logger = logging
 
-        (
-            self.remarkablepp_versions,
-            self.remarkableppm_versions,
-            self.remarkable2_versions,
-            self.remarkable1_versions,
-            self.external_provider_urls,
-        ) = self.get_remarkable_versions()
+        if self.session is None:
+            self.session = create_session(self.pool_size)
+
+        self.cache = FirmwareCache(logger=self.logger)
+        self.metadata = MetadataCache(self.session, logger=self.logger)
+        self.show_progress = True
+
+        # version-ids.json is only read once a version table is first needed, which may be after
+        # a command has changed directory, so the local copy is found relative to where it started
+        self.local_version_ids = os.path.abspath("data/version-ids.json")
+        self.__versions = None
+        self.__versions_lock = threading.RLock()
+        self.__indexes = {}
+
+    @property
+    def remarkablepp_versions(self) -> dict:
+        return self.__load_versions()[0]
+
+    @property
+    def remarkableppm_versions(self) -> dict:
+        return self.__load_versions()[1]
+
+    @property
+    def remarkable2_versions(self) -> dict:
+        return self.__load_versions()[2]
+
+    @property
+    def remarkable1_versions(self) -> dict:
+        return self.__load_versions()[3]
+
+    @property
+    def external_provider_urls(self) -> list:
+        return self.__load_versions()[4]
+
+    def __load_versions(self) -> tuple[dict, dict, dict, dict, list]:
+        """Loads the version tables the first time they are used"""
+        with self.__versions_lock:
+            if self.__versions is None:
+                self.__versions = self.get_remarkable_versions()
+
+        return self.__versions
 
     def get_remarkable_versions(self) -> tuple[dict, dict, dict, dict, list]:
         """Gets the avaliable versions for the device, by checking the local version-ids.json file and then updating it if necessary
@@ -42,10 +151,10 @@ class UpdateManager:
             tuple: A tuple containing the version ids for the remarkablepp, remarkableppm, remarkable2, remarkable1, and external provider urls (in that order)
         """
 
-        if os.path.exists("data/version-ids.json"):
-            file_location = "data/version-ids.json"
+        if os.path.exists(self.local_version_ids):
+            file_location = self.local_version_ids
 
-            self.logger.debug("Found version-ids at data/version-ids.json")
+            self.logger.debug(f"Found version-ids at {file_location}")
 
         else:
             if os.name == "nt":  # Windows
@@ -61,8 +170,8 @@ class UpdateManager:
 
             file_location = folder_location + "/version-ids.json"
 
-            if not os.path.exists(file_location):
-                self.update_version_ids(file_location)
+            # Only hits the network once the cached copy is older than the metadata TTL
+            self.update_version_ids(file_location)
 
         try:
             with open(file_location) as f:
@@ -104,49 +213,168 @@ class UpdateManager:
     def update_version_ids(self, location: str) -> None:
         """Updates the version-ids.json file
 
+        The file is revalidated with a conditional request, and is only replaced
+        once a valid copy has been downloaded. If the update fails the existing
+        file is kept.
+
         Args:
             location (str): Location to save the file
 
         Raises:
-            SystemExit: If the file cannot be updated
+            SystemExit: If the file cannot be updated and there is no existing copy
         """
-        with open(location, "w", newline="\n") as f:
-            try:
-                self.logger.debug("Downloading version-ids.json")
-                contents = requests.get(
-                    "https://raw.githubusercontent.com/Jayy001/codexctl/main/data/version-ids.json"
-                ).json()
-                json.dump(contents, f, indent=4)
-                f.write("\n")
-            except requests.exceptions.Timeout:
-                raise SystemExit(
-                    "Connection timed out while downloading version-ids.json! Do you have an internet connection?"
-                )
-            except Exception as error:
-                raise SystemExit(
-                    f"Unknown error while downloading version-ids.json! {error}"
-                )
+        try:
+            self.logger.debug("Updating version-ids.json")
+            self.metadata.get(VERSION_IDS_URL, location, validate=json.loads)
+        except requests.exceptions.Timeout:
+            raise SystemExit(
+                "Connection timed out while downloading version-ids.json! Do you have an internet connection?"
+            )
+        except Exception as error:
+            raise SystemExit(
+                f"Unknown error while downloading version-ids.json! {error}"
+            )
 
-    def get_latest_version(self, hardware_type: HardwareType) -> str:
-        """Gets the latest version available for the device
+    def get_versions(self, hardware_type: HardwareType) -> dict:
+        """Gets the version ids for the device
 
         Args:
             hardware_type (HardwareType enum): Type of the device
 
         Returns:
-            str: Latest version available for the device
+            dict: Version ids and checksums of every version for the device
         """
         match hardware_type:
             case HardwareType.RM1:
-                versions = self.remarkable1_versions
+                return self.remarkable1_versions
             case HardwareType.RM2:
-                versions = self.remarkable2_versions
+                return self.remarkable2_versions
             case HardwareType.RMPP:
-                versions = self.remarkablepp_versions
+                return self.remarkablepp_versions
             case HardwareType.RMPPM:
-                versions = self.remarkableppm_versions
+                return self.remarkableppm_versions
+
+    def get_version_index(self, hardware_type: HardwareType) -> VersionIndex:
+        """Gets the sorted index of versions available for the device, built once per device type
+
+        Args:
+            hardware_type (HardwareType enum): Type of the device
+
+        Returns:
+            VersionIndex: Index of every version for the device
+        """
+        with self.__versions_lock:
+            if hardware_type not in self.__indexes:
+                self.__indexes[hardware_type] = VersionIndex(
+                    self.get_versions(hardware_type)
+                )
+
+        return self.__indexes[hardware_type]
+
+    def get_latest_version(self, hardware_type: HardwareType) -> str:
+        """Gets the latest version available for the device
+
+        Args:
+            hardware_type (HardwareType enum): Type of the device
+
+        Returns:
+            str: Latest version available for the device
+        """
+        latest = self.get_version_index(hardware_type).latest()
+        if latest is None:
+            raise SystemExit(f"No versions available for {hardware_type.name}")
 
-        return self.__max_version(versions.keys())
+        return latest.version
+
+    def resolve_versions(
+        self, hardware_type: HardwareType, versions: list[str]
+    ) -> list[str]:
+        """Expands version arguments into the version ids they refer to
+
+        Args:
+            hardware_type (HardwareType enum): Type of the device
+            versions (list[str]): Version ids, `latest`, `toltec` or inclusive ranges such as `3.20..latest`
+
+        Returns:
+            list[str]: Version ids without duplicates, oldest first
+        """
+        resolved = []
+        for version in versions:
+            if ".." in version:
+                start, end = version.split("..", 1)
+                for bound in (start, end):
+                    if bound and bound != "latest":
+                        self.check_version(bound, version)
+
+                resolved.extend(
+                    self.get_versions_between(hardware_type, start or None, end or None)
+                )
+            elif version == "latest":
+                resolved.append(self.get_latest_version(hardware_type))
+            elif version == "toltec":
+                resolved.append(self.get_toltec_version(hardware_type))
+            else:
+                self.check_version(version)
+                resolved.append(version)
+
+        return sorted(set(resolved), key=parse_version)
+
+    @staticmethod
+    def check_version(version: str, argument: str | None = None) -> None:
+        """Checks that a version argument is made of dot separated numbers
+
+        Args:
+            version (str): Version id, may be partial (e.g. `3.20`)
+            argument (str, optional): Argument the version was given in. Defaults to the version.
+
+        Raises:
+            SystemExit: If the version can't be parsed
+        """
+        try:
+            parse_version(version)
+        except ValueError:
+            raise SystemExit(
+                f"{argument or version} is not a version id (e.g. 3.20.0.92), "
+                "latest, toltec or a range of versions (e.g. 3.20..latest)"
+            )
+
+    def get_versions_between(
+        self, hardware_type: HardwareType, start: str | None, end: str | None
+    ) -> list[str]:
+        """Gets every version available for the device between two versions (inclusive)
+
+        Bounds may be partial, so `3.20` to `3.22` includes every 3.20, 3.21 and 3.22 release.
+
+        Args:
+            hardware_type (HardwareType enum): Type of the device
+            start (str | None): Oldest version, or None for no lower bound
+            end (str | None): Newest version, `latest`, or None for no upper bound
+
+        Returns:
+            list[str]: Versions between start and end, oldest first
+        """
+        return [
+            record.version
+            for record in self.get_version_index(hardware_type).between(start, end)
+        ]
+
+    def get_cached_version(
+        self, hardware_type: HardwareType, update_version: str
+    ) -> str | None:
+        """Gets the location of a version in the firmware cache
+
+        Args:
+            hardware_type (HardwareType enum): Type of the device
+            update_version (str): Id of version to look up
+
+        Returns:
+            str | None: Location of the cached file, None if it is not cached
+        """
+        record = self.get_version_index(hardware_type).get(update_version)
+        if record is None:
+            return None
+
+        return self.cache.get(record.checksum)
 
     def get_toltec_version(self, hardware_type: HardwareType) -> str:
         """Gets the latest version available toltec for the device
@@ -163,22 +391,30 @@ class UpdateManager:
         except ValueError as ex:
             raise SystemExit(*ex.args)
 
-        response = requests.get("https://toltec-dev.org/stable/Compatibility")
-        if response.status_code != 200:
+        try:
+            compatibility = self.metadata.get(TOLTEC_URL)
+        except requests.exceptions.HTTPError as error:
             raise SystemExit(
-                f"Error: Failed to get toltec compatibility table: {response.status_code}"
+                f"Error: Failed to get toltec compatibility table: {error.response.status_code}"
             )
+        except requests.exceptions.RequestException as error:
+            raise SystemExit(f"Error: Failed to get toltec compatibility table: {error}")
 
-        return self.__max_version(
-            [
+        return max(
+            (
                 x.split("=")[1]
-                for x in response.text.splitlines()
+                for x in compatibility.splitlines()
                 if x.startswith(f"{toltec_type}=")
-            ]
+            ),
+            key=parse_version,
         )
 
     def download_version(
-        self, hardware_type: HardwareType, update_version: str, download_folder: str|None = None
+        self,
+        hardware_type: HardwareType,
+        update_version: str,
+        download_folder: str | None = None,
+        connections: int = 1,
     ) -> str | None:
         """Downloads the specified version of the update
 
@@ -186,11 +422,14 @@ class UpdateManager:
             hardware_type (HardwareType enum): Type of the device
             update_version (str): Id of version to download.
             download_folder (str, optional): Location of download folder. Defaults to download folder for OS.
+            connections (int, optional): Number of connections to download over using range requests. Defaults to 1.
 
         Returns:
             str | None: Location of the file if the download was successful, None otherwise
         """
 
+        self.__ensure_pool_size(connections)
+
         if download_folder is None:
             download_folder = str(Path(
                 os.environ["XDG_DOWNLOAD_DIR"]
@@ -205,86 +444,264 @@ class UpdateManager:
             self.logger.error(
                 f"Download folder {download_folder} does not exist! Creating it now."
             )
-            os.makedirs(download_folder)
+            os.makedirs(download_folder, exist_ok=True)
+
+        source = self.get_version_source(hardware_type, update_version)
+        if source is None:
+            self.logger.error(
+                f"Version {update_version} not found in version-ids.json! Please update your version-ids.json file."
+            )
+            return
+
+        record, file_name, uris = source
+        version_checksum = record.checksum
+
+        cached = self.__export_cached(version_checksum, download_folder, file_name)
+        if cached is not None:
+            return cached
+
+        mirrors = probe_mirrors(uris, self.logger, self.session)
+        unstriped = set()  # Mirrors that took part in a failed striped download
+
+        for i, mirror in enumerate(mirrors):
+            self.logger.debug(f"Trying to download from {mirror.uri}")
+
+            # Other mirrors serving a file of the same size can share the range requests, the
+            # sha256 catches one serving different bytes, which is then retried without them
+            stripe_urls = [
+                other.uri
+                for other in mirrors[i + 1 :]
+                if other.ranges and other.uri not in unstriped and other.size == mirror.size
+            ]
+
+            result = self.__download_version_file(
+                mirror.uri,
+                file_name,
+                download_folder,
+                version_checksum,
+                connections,
+                stripe_urls,
+            )
+
+            if result is None and stripe_urls:
+                # One of the other mirrors may serve a different file of the same size
+                self.logger.debug(f"Retrying {mirror.uri} without other mirrors")
+                unstriped.update(stripe_urls)
+                result = self.__download_version_file(
+                    mirror.uri,
+                    file_name,
+                    download_folder,
+                    version_checksum,
+                    connections,
+                )
+
+            if result is not None:
+                self.logger.debug(f"Successfully downloaded from {mirror.uri}")
+                return result
+
+            self.logger.debug(f"Failed to download from {mirror.uri}, trying next source...")
 
+        self.logger.error(f"Failed to download {file_name} from all sources")
+        return None
+
+    def get_version_source(
+        self, hardware_type: HardwareType, update_version: str
+    ) -> tuple[VersionRecord, str, list[str]] | None:
+        """Gets where a version can be downloaded from
+
+        Args:
+            hardware_type (HardwareType enum): Type of the device
+            update_version (str): Id of version to look up
+
+        Returns:
+            tuple[VersionRecord, str, list[str]] | None: Record of the version, its file name and the locations it can be downloaded from. None if the version doesn't exist
+        """
         BASE_URL = "https://updates-download.cloud.remarkable.engineering/build/reMarkable%20Device%20Beta/RM110"  # Default URL for v2 versions
         BASE_URL_V3 = "https://updates-download.cloud.remarkable.engineering/build/reMarkable%20Device/reMarkable"
 
-        match hardware_type:
-            case HardwareType.RMPP:
-                version_lookup = self.remarkablepp_versions
+        if hardware_type == HardwareType.RM2:
+            BASE_URL_V3 += "2"
 
-            case HardwareType.RMPPM:
-                version_lookup = self.remarkableppm_versions
+        record = self.get_version_index(hardware_type).get(update_version)
+        if record is None:
+            return None
 
-            case HardwareType.RM2:
-                version_lookup = self.remarkable2_versions
-                BASE_URL_V3 += "2"
+        if record.key >= (3,):
+            BASE_URL = BASE_URL_V3
 
-            case HardwareType.RM1:
-                version_lookup = self.remarkable1_versions
+        # LAN mirrors (see `codexctl mirror serve`) are tried alongside the official sources
+        mirror_urls = [
+            url.replace("REPLACE_ID", record.file)
+            for url in os.getenv("CODEXCTL_MIRRORS", "").split(",")
+            if url
+        ]
+
+        if not record.new_engine:
+            file_name = f"{update_version}_{hardware_type.old_download_hw}-{record.file}.signed"
+            return record, file_name, mirror_urls + [f"{BASE_URL}/{update_version}/{file_name}"]
+
+        file_name = f"remarkable-production-memfault-image-{update_version}-{hardware_type.new_download_hw}-public"
+        return (
+            record,
+            file_name,
+            mirror_urls
+            + [
+                provider_url.replace("REPLACE_ID", record.file)
+                for provider_url in self.external_provider_urls
+            ],
+        )
 
-        if update_version not in version_lookup:
+    def open_remote_version(
+        self, hardware_type: HardwareType, update_version: str
+    ) -> HTTPRangeFile | None:
+        """Opens a version on the fastest mirror that supports range requests, without downloading it
+
+        Args:
+            hardware_type (HardwareType enum): Type of the device
+            update_version (str): Id of version to open
+
+        Returns:
+            HTTPRangeFile | None: File reading the version over HTTP, None if no mirror supports range requests
+        """
+        source = self.get_version_source(hardware_type, update_version)
+        if source is None:
             self.logger.error(
                 f"Version {update_version} not found in version-ids.json! Please update your version-ids.json file."
             )
-            return
+            return None
 
-        version_id, version_checksum = version_lookup[update_version]
-        version = tuple([int(x) for x in update_version.split(".")])
-        if version >= (3,):
-            BASE_URL = BASE_URL_V3
+        for mirror in probe_mirrors(source[2], self.logger, self.session):
+            if not mirror.ranges or mirror.size is None:
+                continue
 
-        if version <= (3, 11, 2, 5):
-            file_name = f"{update_version}_{hardware_type.old_download_hw}-{version_id}.signed"
-            file_url = f"{BASE_URL}/{update_version}/{file_name}"
-            self.logger.debug(f"File URL is {file_url}, File name is {file_name}")
-            return self.__download_version_file(
-                file_url, file_name, download_folder, version_checksum
-            )
+            self.logger.debug(f"Reading {update_version} from {mirror.uri}")
+            return HTTPRangeFile(mirror.uri, self.session, mirror.size, logger=self.logger)
 
-        else:
-            file_name = f"remarkable-production-memfault-image-{update_version}-{hardware_type.new_download_hw}-public"
+        return None
 
-            for provider_url in self.external_provider_urls:
-                file_url = provider_url.replace("REPLACE_ID", version_id)
-                self.logger.debug(f"Trying to download from {file_url}")
+    def find_version_file(self, name: str) -> tuple[HardwareType, VersionRecord] | None:
+        """Finds the version a downloaded file name belongs to
 
-                result = self.__download_version_file(
-                    file_url, file_name, download_folder, version_checksum
-                )
+        Args:
+            name (str): File name, as served by the update servers
+
+        Returns:
+            tuple[HardwareType, VersionRecord] | None: Type of the device and record of the version, None if no version has that file name
+        """
+        for hardware_type in HardwareType:
+            for record in self.get_version_index(hardware_type):
+                source = self.get_version_source(hardware_type, record.version)
+                if source is not None and source[1] == name:
+                    return hardware_type, record
 
-                if result is not None:
-                    self.logger.debug(f"Successfully downloaded from {provider_url}")
-                    return result
+        return None
 
-                self.logger.debug(f"Failed to download from {provider_url}, trying next source...")
+    def download_url(self, url: str, download_folder: str, connections: int = 1) -> str | None:
+        """Downloads an update image given by URL, instead of by version id
 
-            self.logger.error(f"Failed to download {file_name} from all sources")
-            return None
+        Images of a version in version-ids.json are checked against its
+        checksum and come from the firmware cache when they are cached. Other
+        files can't be checked, but are otherwise downloaded like versions, and
+        are reused while the server still reports the same size and ETag (or
+        Last-Modified).
 
-    def __generate_xml_data(self) -> str:
-        """Generates and returns XML data for the update request"""
-        params = {
-            "installsource": "scheduler",
-            "requestid": str(uuid.uuid4()),
-            "sessionid": str(uuid.uuid4()),
-            "machineid": "00".zfill(32),
-            "oem": "RM100-753-12345",
-            "appid": "98DA7DF2-4E3E-4744-9DE6-EC931886ABAB",
-            "bootid": str(uuid.uuid4()),
-            "current": "3.2.3.1595",
-            "group": "Prod",
-            "platform": "reMarkable2",
+        Args:
+            url (str): Location of the image
+            download_folder (str): Location of download folder
+            connections (int, optional): Number of connections to download over using range requests. Defaults to 1.
+
+        Returns:
+            str | None: Location of the file if the download was successful, None otherwise
+        """
+        self.__ensure_pool_size(connections)
+
+        name = os.path.basename(urllib.parse.urlsplit(url).path)
+        known = self.find_version_file(name)
+        if known is not None:
+            checksum = known[1].checksum
+            cached = self.__export_cached(checksum, download_folder, name)
+            if cached is not None:
+                return cached
+
+            return self.__download_version_file(url, name, download_folder, checksum, connections)
+
+        # Keyed by the whole URL, so files of the same name from different servers don't collide
+        name = f"codexctl-{hashlib.sha1(url.encode()).hexdigest()[:16]}-{name}"
+        filename = os.path.join(download_folder, name)
+
+        response = self.session.head(url, allow_redirects=True)
+        source = {
+            "url": url,
+            "size": response.headers.get("content-length"),
+            "validator": get_validator(response),
         }
 
-        return """<?xml version="1.0" encoding="UTF-8"?>
-<request protocol="3.0" version="{current}" requestid="{{{requestid}}}" sessionid="{{{sessionid}}}" updaterversion="0.4.2" installsource="{installsource}" ismachine="1">
-    <os version="zg" platform="{platform}" sp="{current}_armv7l" arch="armv7l"></os>
-    <app appid="{{{appid}}}" version="{current}" track="{group}" ap="{group}" bootid="{{{bootid}}}" oem="{oem}" oemversion="2.5.2" alephversion="{current}" machineid="{machineid}" lang="en-US" board="" hardware_class="" delta_okay="false" nextversion="" brand="" client="" >
-        <updatecheck/>
-    </app>
-</request>""".format(**params)
+        try:
+            with open(f"{filename}.source.json") as f:
+                downloaded = json.load(f)
+        except (OSError, ValueError):
+            downloaded = None
+
+        if (
+            downloaded == source
+            and None not in source.values()
+            and os.path.isfile(filename)
+            and str(os.path.getsize(filename)) == source["size"]
+        ):
+            self.logger.debug(f"Using {filename} downloaded earlier")
+            return filename
+
+        result = self.__download_version_file(url, name, download_folder, None, connections)
+        if result is not None:
+            with open(f"{filename}.source.json", "w") as f:
+                json.dump(source, f)
+
+        return result
+
+    def download_versions(
+        self,
+        targets: list[tuple[HardwareType, str]],
+        download_folder: str | None = None,
+        jobs: int = 4,
+        connections: int = 1,
+    ) -> list[tuple[HardwareType, str, str | None]]:
+        """Downloads several versions, running at most `jobs` downloads at once
+
+        Args:
+            targets (list[tuple[HardwareType, str]]): Hardware type and version id of each download
+            download_folder (str, optional): Location of download folder. Defaults to download folder for OS.
+            jobs (int, optional): Number of downloads to run concurrently. Defaults to 4.
+            connections (int, optional): Number of connections each download uses. Defaults to 1.
+
+        Returns:
+            list[tuple[HardwareType, str, str | None]]: Hardware type, version id and location of the file (None if it failed) of each download
+        """
+
+        def download(hardware_type: HardwareType, update_version: str) -> str | None:
+            try:
+                return self.download_version(
+                    hardware_type, update_version, download_folder, connections
+                )
+            except Exception as error:
+                self.logger.error(
+                    f"Failed to download {update_version} for {hardware_type.name}: {error}"
+                )
+                return None
+
+        self.__ensure_pool_size(jobs * connections)
+
+        show_progress = self.show_progress
+        self.show_progress = False  # Concurrent progress bars would overwrite each other
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                files = list(executor.map(lambda target: download(*target), targets))
+        finally:
+            self.show_progress = show_progress
+
+        return [
+            (hardware_type, update_version, filename)
+            for (hardware_type, update_version), filename in zip(targets, files)
+        ]
 
     def __parse_response(self, resp: str) -> tuple[str, str, str] | None:
         """Parses the response from the update server and returns the file name, uri, and version if an update is available
@@ -314,20 +731,33 @@ class UpdateManager:
         return file_version, file_uri, file_name
 
     def __download_version_file(
-        self, uri: str, name: str, download_folder: str, checksum: str
+        self,
+        uri: str,
+        name: str,
+        download_folder: str,
+        checksum: str | None,
+        connections: int = 1,
+        mirror_uris: list[str] | None = None,
     ) -> str | None:
         """Downloads the version file from the server and checks the checksum
 
+        The file is written to a `.part` file, which is only moved to its final
+        location (and added to the firmware cache) once the checksum matches. If
+        a previous download of the same file was interrupted, it is resumed
+        using range requests.
+
         Args:
             uri (str): Location to the file
             name (str): Name of the file
             download_folder (str): Location of download folder
-            checksum (str): Sha256 Checksum of the file
+            checksum (str | None): Sha256 Checksum of the file, None if it isn't known and can't be checked
+            connections (int, optional): Number of range request connections to use if the server supports them. Defaults to 1.
+            mirror_uris (list[str], optional): Other locations of the same file to spread range requests over. Defaults to None.
 
         Returns:
             str | None: Location of the file if the checksum matches, None otherwise
         """
-        response = requests.get(uri, stream=True)
+        response = self.session.get(uri, stream=True)
         if response.status_code != 200:
             self.logger.debug(f"Unable to download update file: {response.status_code}")
             return None
@@ -352,38 +782,74 @@ class UpdateManager:
         self.logger.debug(f"{name} is {file_length} bytes")
 
         filename = f"{download_folder}/{name}"
-        with open(filename, "wb") as out_file:
-            dl = 0
+        part_filename = f"{filename}.part"
+
+        # Keyed by the checksum, so progress carries over when another mirror is used
+        state = DownloadState.load(part_filename, file_length, get_validator(response), checksum)
+
+        if connections > 1 and supports_ranges(response):
+            response.close()
+
+            self.logger.debug(f"Downloading {name} over {connections} connections")
+            if not RangedDownload(
+                [uri] + (mirror_uris or []),
+                state,
+                connections,
+                logger=self.logger,
+                progress=self.show_progress,
+                session=self.session,
+            ).run():
+                self.logger.error(
+                    f"Failed to download all segments of {name}, run again to resume"
+                )
+                return None
 
-            for data in response.iter_content(chunk_size=4096):
-                dl += len(data)
-                out_file.write(data)
-                if sys.stdout.isatty():
-                    done = int(50 * dl / file_length)
-                    sys.stdout.write("\r[%s%s]" % ("=" * done, " " * (50 - done)))
-                    sys.stdout.flush()
+            file_checksum = hash_file(part_filename)
 
-        if sys.stdout.isatty():
-            print(end="\r\n")
+        else:
+            file_checksum = stream_download(
+                response, uri, state, self.logger, self.show_progress, self.session
+            )
+            if file_checksum is None:
+                return None
 
         self.logger.debug(f"Downloaded {name}")
+        state.remove()
 
-        with open(filename, "rb") as f:
-            file_checksum = hashlib.sha256(f.read()).hexdigest()
+        if checksum is None:
+            self.logger.warning(f"{name} isn't in version-ids.json, so its checksum can't be checked")
+            checksum = file_checksum
 
         if file_checksum != checksum:
-            os.remove(filename)
+            os.remove(part_filename)
             self.logger.error(
                 f"File checksum mismatch! Expected {checksum}, got {file_checksum}"
             )
             return None
 
+        os.replace(part_filename, filename)
+        self.cache.add(filename, checksum)
+
         return filename
 
-    @staticmethod
-    def __max_version(versions: list) -> str:
-        """Returns the highest avaliable version from a list with semantic versioning"""
-        return sorted(versions, key=lambda v: tuple(map(int, v.split("."))))[-1]
+    def __export_cached(self, checksum: str, download_folder: str, name: str) -> str | None:
+        """Places a cached file in the download folder, None if it isn't cached"""
+        if self.cache.get(checksum) is None:
+            return None
+
+        self.logger.debug(f"Using cached copy of {name}")
+        try:
+            return self.cache.export(checksum, download_folder, name)
+        except FileNotFoundError:
+            # Evicted by another download since the lookup
+            self.logger.debug(f"Cached copy of {name} was evicted, downloading it")
+            return None
+
+    def __ensure_pool_size(self, size: int) -> None:
+        """Grows the session's connection pools to fit `size` concurrent requests per host"""
+        if size > self.pool_size:
+            self.pool_size = size
+            mount_adapters(self.session, self.pool_size)
 
     @staticmethod
     def uses_new_update_engine(version: str) -> bool:
@@ -396,7 +862,7 @@ class UpdateManager:
         Returns:
             bool: If it uses the new update engine or not
         """
-        return tuple([int(x) for x in version.split(".")]) > (3, 11, 2, 5)
+        return parse_version(version) > NEW_UPDATE_ENGINE
 
     @staticmethod
     def is_bootloader_boundary_downgrade(current_version: str, target_version: str) -> bool:
@@ -422,15 +888,15 @@ class UpdateManager:
             raise ValueError("target_version cannot be empty")
 
         try:
-            current_parts = [int(x) for x in current_version.split('.')]
-            target_parts = [int(x) for x in target_version.split('.')]
+            current_parts = parse_version(current_version)
+            target_parts = parse_version(target_version)
         except ValueError as e:
             raise ValueError(f"Invalid version format: {e}") from e
 
         if len(current_parts) < 2 or len(target_parts) < 2:
             raise ValueError("Version must have at least 2 components (e.g., '3.22')")
 
-        current_is_322_or_higher = current_parts >= [3, 22]
-        target_is_below_322 = target_parts < [3, 22]
+        current_is_322_or_higher = current_parts >= BOOTLOADER_BOUNDARY
+        target_is_below_322 = target_parts < BOOTLOADER_BOUNDARY
 
         return current_is_322_or_higher and target_is_below_322
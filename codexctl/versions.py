@@ -0,0 +1,112 @@
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from typing import NamedTuple
+
+NEW_UPDATE_ENGINE = (3, 11, 2, 5)  # Versions above this use the new update engine
+BOOTLOADER_BOUNDARY = (3, 22)  # Paper Pro bootloader changed in 3.22
+
+
+@lru_cache(maxsize=None)
+def parse_version(version: str) -> tuple[int, ...]:
+    """Parses a version id such as `3.20.0.92` into a tuple of ints for comparing versions
+
+    Args:
+        version (str): Version id, may be partial (e.g. `3.20`)
+
+    Returns:
+        tuple[int, ...]: Parsed version
+
+    Raises:
+        ValueError: If the version isn't made of dot separated numbers
+    """
+    return tuple(map(int, version.split(".")))
+
+
+def prefix_upper_bound(version: tuple[int, ...]) -> tuple[int, ...]:
+    """Returns the lowest version that doesn't start with the given (partial) version"""
+    return version[:-1] + (version[-1] + 1,)
+
+
+class VersionRecord(NamedTuple):
+    """A single firmware version, as listed in version-ids.json"""
+
+    version: str
+    key: tuple[int, ...]
+    file: str
+    checksum: str
+    new_engine: bool  # Installed with the new (swupdate) update engine
+    new_bootloader: bool  # 3.22 or newer, ships the new Paper Pro bootloader
+
+
+class VersionIndex:
+    def __init__(self, versions: dict) -> None:
+        """Sorted index of the versions available for a device
+
+        Versions are parsed once and kept oldest first, so lookups and range
+        queries are bisections instead of parsing and sorting every version.
+
+        Args:
+            versions (dict): Version ids mapped to their file name and checksum, as in version-ids.json
+        """
+        records = []
+        for version, (file, checksum) in versions.items():
+            key = parse_version(version)
+            records.append(
+                VersionRecord(
+                    version,
+                    key,
+                    file,
+                    checksum,
+                    key > NEW_UPDATE_ENGINE,
+                    key >= BOOTLOADER_BOUNDARY,
+                )
+            )
+
+        self.records = sorted(records, key=lambda record: record.key)
+        self.keys = [record.key for record in self.records]
+        self.by_version = {record.version: record for record in self.records}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __contains__(self, version: str) -> bool:
+        return version in self.by_version
+
+    def get(self, version: str) -> VersionRecord | None:
+        """Gets the record of a version id, None if it isn't available"""
+        return self.by_version.get(version)
+
+    def latest(self) -> VersionRecord | None:
+        """Gets the newest version, None if there are no versions"""
+        return self.records[-1] if self.records else None
+
+    def between(self, start: str | None, end: str | None) -> list[VersionRecord]:
+        """Gets every version between two versions (inclusive), oldest first
+
+        Bounds may be partial, so `3.20` to `3.22` includes every 3.20, 3.21 and 3.22 release.
+
+        Args:
+            start (str | None): Oldest version, or None for no lower bound
+            end (str | None): Newest version, `latest`, or None for no upper bound
+
+        Returns:
+            list[VersionRecord]: Versions between start and end
+        """
+        lower = bisect_left(self.keys, parse_version(start)) if start else 0
+        upper = len(self.keys)
+        if end and end != "latest":
+            upper = bisect_left(self.keys, prefix_upper_bound(parse_version(end)))
+
+        return self.records[lower:upper]
+
+    def newer_than(self, version: str) -> list[VersionRecord]:
+        """Gets every version newer than the given version, oldest first"""
+        return self.records[bisect_right(self.keys, parse_version(version)) :]
+
+    def next_newer(self, version: str) -> VersionRecord | None:
+        """Gets the first version newer than the given version, None if it is the newest"""
+        index = bisect_right(self.keys, parse_version(version))
+        return self.records[index] if index < len(self.records) else None
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Measures the wall-clock time of codexctl commands
+
+Runs a command several times in fresh interpreters, so import time and
+everything done before the command itself is included. Pass --baseline with
+another checkout of codexctl (e.g. from `git worktree add`) to compare both.
+
+Example:
+    python scripts/benchmark-startup.py --runs 20 --baseline ../codexctl-main -- ls .venv/update.swu /
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def measure(source: str, command: list[str], runs: int) -> list[float]:
+    """Runs `python -m codexctl command` from a source tree and times each run
+
+    Args:
+        source (str): Folder containing the codexctl package
+        command (list[str]): Arguments passed to codexctl
+        runs (int): Number of times to run the command
+
+    Returns:
+        list[float]: Wall-clock time of each run in seconds
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.abspath(source)] + [x for x in [env.get("PYTHONPATH")] if x]
+    )
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-m", "codexctl", *command],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        times.append(time.perf_counter() - start)
+
+        if process.returncode != 0:
+            raise SystemExit(
+                f"codexctl {' '.join(command)} failed in {source}:\n{process.stderr.decode()}"
+            )
+
+    return times
+
+
+def report(name: str, times: list[float]) -> None:
+    print(
+        f"{name}: min {min(times) * 1000:.1f} ms, "
+        f"median {statistics.median(times) * 1000:.1f} ms, "
+        f"mean {statistics.mean(times) * 1000:.1f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", "-n", type=int, default=10, help="Runs per tree")
+    parser.add_argument(
+        "--source",
+        default=os.path.join(os.path.dirname(__file__), ".."),
+        help="Checkout to benchmark (defaults to this one)",
+    )
+    parser.add_argument("--baseline", help="Checkout to compare against")
+    parser.add_argument("command", nargs="+", help="codexctl command to run")
+    args = parser.parse_args()
+
+    trees = [("current", args.source)]
+    if args.baseline is not None:
+        trees.insert(0, ("baseline", args.baseline))
+
+    results = {}
+    for name, source in trees:
+        measure(source, args.command, 1)  # Warm up the filesystem and bytecode caches
+        results[name] = measure(source, args.command, args.runs)
+        report(name, results[name])
+
+    if args.baseline is not None:
+        speedup = statistics.median(results["baseline"]) / statistics.median(
+            results["current"]
+        )
+        print(f"speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
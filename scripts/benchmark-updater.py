@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""Load tests the fake Omaha updater with simulated update_engine clients
+
+Starts an updater in this process and runs N clients against it at once. Each
+client checks for an update with the request the old update engine sends,
+reports the download starting, downloads and verifies the payload (optionally
+limited to a bandwidth) and reports the download finishing, like a device.
+Latency percentiles of each step and the aggregate throughput are reported.
+
+Example:
+    python scripts/benchmark-updater.py --clients 50 --payload-size 64M --rate 2M
+"""
+
+import argparse
+import base64
+import hashlib
+import http.client
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from codexctl.cache import format_size, parse_size  # noqa: E402
+from codexctl.omaha import AsyncUpdateServer  # noqa: E402
+from codexctl.server import PayloadHashes  # noqa: E402
+from codexctl.updates import generate_xml_data  # noqa: E402
+
+EVENT_DOWNLOAD_STARTED = 13
+EVENT_DOWNLOAD_FINISHED = 14
+READ_SIZE = 64 * 1024
+PLATFORM = "reMarkable2"
+VERSION = "3.5.2.1807"
+
+
+class Client(threading.Thread):
+    def __init__(self, address: tuple[str, int], rate: int | None, barrier: threading.Barrier) -> None:
+        """Simulated device updating from the fake updater
+
+        Args:
+            address (tuple[str, int]): Host and port of the updater
+            rate (int | None): Bytes per second to download at, None for no limit
+            barrier (threading.Barrier): Barrier every client waits on, so they start together
+        """
+        super().__init__(daemon=True)
+
+        self.address = address
+        self.rate = rate
+        self.barrier = barrier
+        self.machine_id = uuid.uuid4().hex
+        self.boot_id = str(uuid.uuid4())
+        self.timings = {}
+        self.events = []
+        self.received = 0
+        self.error = None
+
+    def run(self) -> None:
+        self.barrier.wait()
+        started = time.perf_counter()
+        try:
+            self.update()
+        except (OSError, http.client.HTTPException, ValueError) as error:
+            self.error = f"{error.__class__.__name__}: {error}"
+
+        self.timings["total"] = time.perf_counter() - started
+
+    def update(self) -> None:
+        start = time.perf_counter()
+        status, body = self.post(generate_xml_data(PLATFORM, machineid=self.machine_id, bootid=self.boot_id))
+        self.timings["updatecheck"] = time.perf_counter() - start
+        self.events.append(f"updatecheck:{status}")
+
+        response = ET.fromstring(body)
+        manifest = response.find("app/updatecheck/manifest")
+        if manifest is None:
+            raise ValueError("No update offered")
+
+        codebase = response.find("app/updatecheck/urls/url").attrib["codebase"]
+        package = manifest.find("packages/package").attrib
+        sha256 = manifest.find("actions/action").attrib["sha256"]
+
+        self.event(EVENT_DOWNLOAD_STARTED, 1)
+        verified = self.download(codebase + package["name"], int(package["size"]), sha256)
+        self.event(EVENT_DOWNLOAD_FINISHED, 1 if verified else 0)
+
+        if not verified:
+            raise ValueError("Payload did not match its sha256")
+
+    def event(self, event_type: int, result: int) -> None:
+        try:
+            status, _ = self.post(
+                generate_xml_data(
+                    PLATFORM,
+                    machineid=self.machine_id,
+                    bootid=self.boot_id,
+                    event=(event_type, result),
+                )
+            )
+        except (http.client.RemoteDisconnected, ConnectionResetError):
+            status = "closed"  # Some events are not answered
+
+        self.events.append(f"{event_type}:{status}")
+
+    def post(self, body: str) -> tuple[int, bytes]:
+        connection = http.client.HTTPConnection(*self.address, timeout=60)
+        try:
+            connection.request("POST", "/", body.encode(), {"Content-Type": "text/xml"})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def download(self, url: str, size: int, sha256: str) -> bool:
+        connection = http.client.HTTPConnection(*self.address, timeout=60)
+        digest = hashlib.sha256()
+        try:
+            start = time.perf_counter()
+            connection.request("GET", urllib.parse.urlsplit(url).path)
+            response = connection.getresponse()
+            self.timings["ttfb"] = time.perf_counter() - start
+            self.events.append(f"download:{response.status}")
+
+            while data := response.read(READ_SIZE):
+                digest.update(data)
+                self.received += len(data)
+
+                # Sleep off any time gained on the rate, like a device on slow Wi-Fi
+                if self.rate is not None:
+                    ahead = self.received / self.rate - (time.perf_counter() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+            self.timings["download"] = time.perf_counter() - start
+        finally:
+            connection.close()
+
+        return self.received == size and base64.b64encode(digest.digest()).decode() == sha256
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "no samples"
+
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        return values[min(int(p / 100 * len(values)), len(values) - 1)]
+
+    return (
+        f"p50 {rank(50) * 1000:.1f} ms, p90 {rank(90) * 1000:.1f} ms, "
+        f"p99 {rank(99) * 1000:.1f} ms, max {values[-1] * 1000:.1f} ms"
+    )
+
+
+def start_server(folder: str, update_name: str) -> tuple[str, int]:
+    """Starts an updater serving the payload in a folder, returning its address"""
+    versions = {PLATFORM: (VERSION, update_name)}
+    hashes = PayloadHashes(os.path.join(folder, "payload-hashes.json"))
+    updates = os.path.join(folder, "updates")
+
+    server = AsyncUpdateServer(("127.0.0.1", 0), versions, folder=updates, hashes=hashes)
+    server.start_thread()
+
+    # Hash before the clients start, so the first update check isn't measuring it
+    server.prepare().join()
+    return server.server_address
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", "-n", type=int, default=10, help="Simulated devices")
+    parser.add_argument("--payload-size", default="16M", help="Size of the generated payload")
+    parser.add_argument("--rate", help="Download bandwidth of each device, e.g. 2M (bytes/s)")
+    args = parser.parse_args()
+
+    rate = parse_size(args.rate) if args.rate else None
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as folder:
+        update_name = f"{VERSION}_{PLATFORM}-benchmark.signed"
+        os.mkdir(os.path.join(folder, "updates"))
+        with open(os.path.join(folder, "updates", update_name), "wb") as f:
+            f.write(os.urandom(parse_size(args.payload_size)))
+
+        address = start_server(folder, update_name)
+
+        # The fake updater prints and logs every request, which isn't part of the measurement
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+        try:
+            barrier = threading.Barrier(args.clients + 1)
+            clients = [Client(address, rate, barrier) for _ in range(args.clients)]
+            for client in clients:
+                client.start()
+
+            barrier.wait()
+            start = time.perf_counter()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout, sys.stderr = stdout, stderr
+
+    failed = [client for client in clients if client.error is not None]
+    received = sum(client.received for client in clients)
+
+    print(f"{args.clients} clients, {args.payload_size} payload")
+    for step in ("updatecheck", "ttfb", "download", "total"):
+        samples = [client.timings[step] for client in clients if step in client.timings]
+        print(f"{step}: {percentiles(samples)}")
+
+    print(f"throughput: {format_size(int(received / elapsed))}/s ({format_size(received)} in {elapsed:.2f} s)")
+
+    sequences = statistics.multimode(" ".join(client.events) for client in clients)
+    print(f"most common event sequence: {sequences[0]}")
+    print(f"failed: {len(failed)}")
+    for client in failed[:10]:
+        print(f"  {client.machine_id}: {client.error}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,13 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 
 from codexctl.device import HardwareType, DeviceManager
 from codexctl.updates import UpdateManager
+from codexctl.download import DownloadState
+from codexctl.versions import VersionIndex
+from codexctl.remote import CPIOArchive
+from codexctl.cache import FirmwareCache
+from codexctl.mirror import MirrorServer
+from codexctl.omaha import AsyncUpdateServer
+from codexctl.server import PayloadHashes, UpdateIndex
 from codexctl import Manager
 
 # Mock device manager object, only the `logger` field is accessed by `set_server_config`
@@ -23,6 +30,7 @@ from io import BytesIO
 
 FAILED = False
 UPDATE_FILE_PATH = ".venv/2.15.1.1189_reMarkable2-wVbHkgKisg-.signed"
+SWU_FILE_PATH = ".venv/remarkable-production-memfault-image-3.20.0.92-rm2-public"
 
 assert os.path.exists(UPDATE_FILE_PATH), "Update image missing"
 
@@ -248,5 +256,483 @@ with assert_raises("empty string current", ValueError):
 with assert_raises("non-numeric version", ValueError):
     UpdateManager.is_bootloader_boundary_downgrade("abc.def", "3.20.0.92")
 
+download_state = DownloadState("fw.part", 100, None)
+download_state.add(10, 19, save=False)
+download_state.add(20, 29, save=False)
+download_state.add(50, 59, save=False)
+assert_value(
+    "download state merges ranges",
+    download_state.completed,
+    [[10, 29], [50, 59]]
+)
+assert_value("download state prefix", download_state.prefix(), 0)
+assert_value(
+    "download state missing segments",
+    download_state.missing(16),
+    [(0, 9), (30, 45), (46, 49), (60, 75), (76, 91), (92, 99)]
+)
+download_state.add(0, 9, save=False)
+assert_value("download state resumed prefix", download_state.prefix(), 30)
+
+import tempfile
+
+from codexctl.download import CHUNK_SIZE, stream_download
+
+
+class EmptyResponse:
+    """Response whose connection drops before the first chunk"""
+
+    headers = {"accept-ranges": "bytes"}
+
+    def iter_content(self, chunk_size):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+with tempfile.TemporaryDirectory() as download_folder:
+    empty_state = DownloadState(os.path.join(download_folder, "fw.part"), 100, None)
+    assert_value(
+        "interrupted download returns nothing",
+        stream_download(EmptyResponse(), "http://127.0.0.1/fw", empty_state, progress=False),
+        None
+    )
+    assert_value("interrupted download keeps every segment missing", empty_state.missing(), [(0, 99)])
+    assert_value(
+        "interrupted download stores no ranges",
+        DownloadState.load(empty_state.filename, 100, None).completed,
+        []
+    )
+
+    with open(empty_state.filename, "wb") as f:
+        f.write(bytes(50))
+    mirror_state = DownloadState(empty_state.filename, 100, '"mirror-a"', "abc")
+    mirror_state.add(0, 49)
+    assert_value(
+        "download state resumes from another mirror with the same checksum",
+        DownloadState.load(mirror_state.filename, 100, '"mirror-b"', "abc").completed,
+        [[0, 49]]
+    )
+    assert_value(
+        "download state restarts for another file",
+        DownloadState.load(mirror_state.filename, 100, '"mirror-b"', "def").completed,
+        []
+    )
+
+import hashlib
+import threading
+import time
+
+import requests
+
+from http.server import ThreadingHTTPServer
+from codexctl.download import RangedDownload, hash_file
+from codexctl.fileserver import FileRequestHandler
+
+
+class FolderRequestHandler(FileRequestHandler):
+    """Serves the files in the server's folder, dropping the connection after `drop_after` bytes if set"""
+
+    def resolve(self, path):
+        return os.path.join(self.server.folder, os.path.basename(path)), None
+
+    def copy_file(self, f, length):
+        if self.server.drop_after is not None and self.server.drop_after < length:
+            length = self.server.drop_after
+            self.close_connection = True
+
+        super().copy_file(f, length)
+
+    def log_request(self, code="-", size="-"):
+        self.server.statuses.append(int(code))
+
+    def log_message(self, format, *args):
+        pass
+
+
+with tempfile.TemporaryDirectory() as serve_folder, tempfile.TemporaryDirectory() as download_folder:
+    served = os.urandom(4 * CHUNK_SIZE)
+    served_checksum = hashlib.sha256(served).hexdigest()
+    with open(os.path.join(serve_folder, "fw"), "wb") as f:
+        f.write(served)
+
+    file_server = ThreadingHTTPServer(("127.0.0.1", 0), FolderRequestHandler)
+    file_server.folder = serve_folder
+    file_server.drop_after = None
+    file_server.statuses = []
+    threading.Thread(target=file_server.serve_forever, daemon=True).start()
+    served_url = f"http://127.0.0.1:{file_server.server_address[1]}/fw"
+    download_session = requests.Session()
+
+    def download_from_server(state):
+        response = download_session.get(served_url, stream=True)
+        return stream_download(response, served_url, state, progress=False, session=download_session)
+
+    # A ranged download left two ranges, then the download continues over one connection
+    part_filename = os.path.join(download_folder, "fw.part")
+    with open(part_filename, "wb") as f:
+        f.write(served[:CHUNK_SIZE] + bytes(CHUNK_SIZE) + served[2 * CHUNK_SIZE:3 * CHUNK_SIZE])
+
+    validator = requests.head(served_url).headers["ETag"]
+    switched_state = DownloadState(part_filename, len(served), validator)
+    switched_state.add(0, CHUNK_SIZE - 1)
+    switched_state.add(2 * CHUNK_SIZE, 3 * CHUNK_SIZE - 1)
+
+    file_server.drop_after = CHUNK_SIZE
+    assert_value("stream download after ranged download is interrupted", download_from_server(switched_state), None)
+    assert_value(
+        "stream download drops ranges past its offset",
+        DownloadState.load(part_filename, len(served), validator).completed,
+        [[0, 2 * CHUNK_SIZE - 1]]
+    )
+
+    file_server.drop_after = None
+    assert_value(
+        "stream download resumes after ranged download",
+        download_from_server(DownloadState.load(part_filename, len(served), validator)),
+        served_checksum
+    )
+
+    # A download over one connection is cut off, then resumed with a range request
+    part_filename = os.path.join(download_folder, "fw-stream.part")
+    file_server.drop_after = 2 * CHUNK_SIZE
+    assert_value(
+        "stream download is interrupted",
+        download_from_server(DownloadState(part_filename, len(served), validator)),
+        None
+    )
+    assert_value(
+        "stream download keeps what it downloaded",
+        DownloadState.load(part_filename, len(served), validator).completed,
+        [[0, 2 * CHUNK_SIZE - 1]]
+    )
+
+    file_server.drop_after = None
+    del file_server.statuses[:]
+    assert_value(
+        "stream download resumes",
+        download_from_server(DownloadState.load(part_filename, len(served), validator)),
+        served_checksum
+    )
+    assert_value("stream download resumes with a range request", file_server.statuses, [200, 206])
+
+    # Every range request is cut off until the mirror is given up on, then the download is run again
+    part_filename = os.path.join(download_folder, "fw-ranged.part")
+    ranged_logger = NonCallableMock(["debug", "error"])
+
+    def ranged_download(state):
+        return RangedDownload(
+            [served_url],
+            state,
+            connections=1,
+            segment_size=len(served),
+            logger=ranged_logger,
+            progress=False,
+            session=download_session,
+        ).run()
+
+    file_server.drop_after = CHUNK_SIZE
+    assert_value(
+        "ranged download gives up on a failing mirror",
+        ranged_download(DownloadState(part_filename, len(served), validator)),
+        False
+    )
+    assert_value(
+        "ranged download keeps interrupted segments",
+        DownloadState.load(part_filename, len(served), validator).completed,
+        [[0, 3 * CHUNK_SIZE - 1]]
+    )
+
+    file_server.drop_after = None
+    del file_server.statuses[:]
+    assert_value(
+        "ranged download resumes",
+        (ranged_download(DownloadState.load(part_filename, len(served), validator)), hash_file(part_filename)),
+        (True, served_checksum)
+    )
+    assert_value("ranged download only fetches what is missing", file_server.statuses, [206])
+
+version_index = VersionIndex({
+    "3.22.0.64": ["c", "3"],
+    "2.15.1.1189": ["a", "1"],
+    "3.20.0.92": ["b", "2"],
+    "3.22.1.1": ["d", "4"],
+})
+assert_value("version index latest", version_index.latest().version, "3.22.1.1")
+assert_value(
+    "version index between",
+    [x.version for x in version_index.between("3.20", "3.22.0.64")],
+    ["3.20.0.92", "3.22.0.64"]
+)
+assert_value(
+    "version index between partial",
+    [x.version for x in version_index.between(None, "3.22")],
+    ["2.15.1.1189", "3.20.0.92", "3.22.0.64", "3.22.1.1"]
+)
+assert_value("version index next newer", version_index.next_newer("3.20.0.92").version, "3.22.0.64")
+assert_value("version index newest has no next", version_index.next_newer("3.22.1.1"), None)
+assert_value("version index old engine", version_index.get("2.15.1.1189").new_engine, False)
+assert_value("version index bootloader era", version_index.get("3.22.0.64").new_bootloader, True)
+with assert_raises("resolve versions rejects invalid ids", SystemExit):
+    updater.resolve_versions(HardwareType.RM2, ["2.15.1.1189x"])
+with assert_raises("resolve versions rejects invalid ranges", SystemExit):
+    updater.resolve_versions(HardwareType.RM2, ["3.x..latest"])
+
+from remarkable_update_image import UpdateImage
+
+with open(SWU_FILE_PATH, "rb") as f:
+    swu_archive = CPIOArchive(f)
+    assert_value(
+        "cpio archive reads members",
+        swu_archive.read("sw-description"),
+        UpdateImage(SWU_FILE_PATH).archive[b"sw-description"].read()
+    )
+    assert_gt("cpio archive finds checksums", len(swu_archive.checksums()), 1)
+    with assert_raises("cpio archive refuses members without a checksum", ValueError):
+        swu_archive.read_verified("sw-description")
+
+with tempfile.TemporaryDirectory() as cache_folder:
+    firmware = os.urandom(100000)
+    firmware_checksum = hashlib.sha256(firmware).hexdigest()
+    with open(os.path.join(cache_folder, "fw"), "wb") as f:
+        f.write(firmware)
+
+    mirror_cache = FirmwareCache(cache_folder, logger=logging.getLogger(__name__))
+    mirror_cache.add(os.path.join(cache_folder, "fw"), firmware_checksum)
+
+    mirror = MirrorServer(
+        ("127.0.0.1", 0),
+        {HardwareType.RM2: {"3.20.0.92": ["fw-id", firmware_checksum]}},
+        mirror_cache,
+        logging.getLogger(__name__),
+    )
+    threading.Thread(target=mirror.serve_forever, daemon=True).start()
+    mirror_url = f"http://127.0.0.1:{mirror.server_address[1]}/fw-id"
+
+    assert_value("mirror serves cached firmware", requests.get(mirror_url).content, firmware)
+    response = requests.get(mirror_url, headers={"Range": "bytes=1000-1999"})
+    assert_value("mirror serves ranges", (response.status_code, response.content), (206, firmware[1000:2000]))
+    assert_value("mirror unknown version", requests.get(mirror_url + "x").status_code, 404)
+    assert_value("mirror requests aren't cache hits", mirror_cache.stats()["hits"], 0)
+
+    mirror.shutdown()
+    mirror.server_close()
+
+with tempfile.TemporaryDirectory() as cache_folder:
+    cache_logger = NonCallableMock(["debug", "warning"])
+    firmware_cache = FirmwareCache(cache_folder, logger=cache_logger)
+    firmware_cache.set_max_size(250)
+
+    cached_checksums = {}
+    for name in ("a", "b", "c"):
+        with open(os.path.join(cache_folder, name), "wb") as f:
+            f.write(name.encode() * 100)
+        cached_checksums[name] = hashlib.sha256(name.encode() * 100).hexdigest()
+
+    firmware_cache.add(os.path.join(cache_folder, "a"), cached_checksums["a"])
+    time.sleep(0.01)
+    firmware_cache.add(os.path.join(cache_folder, "b"), cached_checksums["b"])
+    time.sleep(0.01)
+    firmware_cache.get(cached_checksums["a"])
+    time.sleep(0.01)
+    firmware_cache.add(os.path.join(cache_folder, "c"), cached_checksums["c"])
+
+    def cached_names():
+        return sorted(entry["name"] for entry in firmware_cache.stats()["entries"].values())
+
+    assert_value("firmware cache evicts least recently used", cached_names(), ["a", "c"])
+    assert_value("firmware cache removes evicted files", firmware_cache.peek(cached_checksums["b"]), None)
+    assert_value("firmware cache stays within its limit", firmware_cache.stats()["size"], 200)
+
+    firmware_cache.pin(cached_checksums["c"])
+    firmware_cache.set_max_size(100)
+    assert_value("firmware cache evicts when its limit shrinks", cached_names(), ["c"])
+    assert_value("firmware cache keeps its limit", firmware_cache.stats()["max-size"], 100)
+
+    firmware_cache.set_max_size(50)
+    assert_value("firmware cache keeps pinned files over its limit", cached_names(), ["c"])
+    assert_value("firmware cache warns when pinned files don't fit", cache_logger.warning.called, True)
+
+    firmware_cache.unpin(cached_checksums["c"])
+    assert_value("firmware cache evicts unpinned files", cached_names(), [])
+    assert_value(
+        "firmware cache counts hits and misses",
+        (firmware_cache.get(cached_checksums["c"]), firmware_cache.stats()["hits"], firmware_cache.stats()["misses"]),
+        (None, 1, 1)
+    )
+
+from codexctl.cache import MetadataCache
+
+with tempfile.TemporaryDirectory() as serve_folder, tempfile.TemporaryDirectory() as cache_folder:
+    with open(os.path.join(serve_folder, "version-ids.json"), "w") as f:
+        f.write('{"remarkable2": {}}')
+
+    metadata_server = ThreadingHTTPServer(("127.0.0.1", 0), FolderRequestHandler)
+    metadata_server.folder = serve_folder
+    metadata_server.drop_after = None
+    metadata_server.statuses = []
+    threading.Thread(target=metadata_server.serve_forever, daemon=True).start()
+    metadata_url = f"http://127.0.0.1:{metadata_server.server_address[1]}/version-ids.json"
+    metadata_logger = NonCallableMock(["debug", "warning"])
+
+    def get_metadata(ttl, url=metadata_url):
+        # A new cache each time, as a cache keeps what it has read in memory for the rest of the run
+        return MetadataCache(requests.Session(), cache_folder, ttl, metadata_logger).get(url)
+
+    assert_value("metadata cache fetches files", get_metadata(60), '{"remarkable2": {}}')
+    assert_value(
+        "metadata cache serves fresh files without a request",
+        (get_metadata(60), metadata_server.statuses),
+        ('{"remarkable2": {}}', [200])
+    )
+    assert_value(
+        "metadata cache revalidates expired files",
+        (get_metadata(0), metadata_server.statuses),
+        ('{"remarkable2": {}}', [200, 304])
+    )
+
+    with open(os.path.join(serve_folder, "version-ids.json"), "w") as f:
+        f.write('{"remarkable2": {"3.20.0.92": []}}')
+    assert_value(
+        "metadata cache fetches changed files",
+        (get_metadata(0), metadata_server.statuses),
+        ('{"remarkable2": {"3.20.0.92": []}}', [200, 304, 200])
+    )
+
+    metadata_server.shutdown()
+    metadata_server.server_close()
+    assert_value(
+        "metadata cache serves cached files offline",
+        (get_metadata(0), metadata_logger.warning.called),
+        ('{"remarkable2": {"3.20.0.92": []}}', True)
+    )
+    with assert_raises("metadata cache fails offline without a cached copy", requests.exceptions.ConnectionError):
+        get_metadata(0, metadata_url + "x")
+
+import logging.handlers
+import xml.etree.ElementTree as ET
+
+from codexctl.fileserver import SOCKET_BUFFER_SIZE
+
+orig_cwd = os.getcwd()
+with tempfile.TemporaryDirectory() as updates_folder:
+    os.chdir(updates_folder)
+    os.mkdir("updates")
+    # Larger than the socket buffers, so the server is still sending when a client hangs up
+    payload = os.urandom(8 * SOCKET_BUFFER_SIZE)
+    with open("updates/3.5.2.1807_reMarkable2-test.signed", "wb") as f:
+        f.write(payload)
+
+    with open("updates/3.3.2.1666_reMarkable2-test.signed", "wb") as f:
+        f.write(payload[:1000])
+
+    update_index = UpdateIndex("updates")
+    assert_value("update index picks newest", update_index.versions()["reMarkable2"][0], "3.5.2.1807")
+    open("updates/3.10.0.1_reMarkable2-test.signed", "wb").close()
+    assert_value("update index orders numerically", update_index.versions()["reMarkable2"][0], "3.10.0.1")
+    assert_value(
+        "update index finds version",
+        update_index.get("3.3.2.1666"),
+        {"reMarkable2": ("3.3.2.1666", "3.3.2.1666_reMarkable2-test.signed")}
+    )
+    os.remove("updates/3.10.0.1_reMarkable2-test.signed")
+    assert_value("update index drops removed payloads", update_index.get("3.10.0.1"), None)
+
+    hashes_logger = NonCallableMock(["error"])
+    PayloadHashes(os.path.join(updates_folder, "payload-hashes.json"), hashes_logger).prepare(
+        ["updates/missing.signed"]
+    ).join()
+    assert_value("payload hashes log payloads they can't hash", hashes_logger.error.called, True)
+
+    updater_server = AsyncUpdateServer(
+        ("127.0.0.1", 0),
+        {"reMarkable2": ("3.5.2.1807", "3.5.2.1807_reMarkable2-test.signed")},
+        hashes=PayloadHashes(os.path.join(updates_folder, "payload-hashes.json")),
+    )
+    updater_server.start_thread()
+    updater_url = f"http://127.0.0.1:{updater_server.server_address[1]}/"
+    payload_url = updater_url + "updates/3.5.2.1807_reMarkable2-test.signed"
+
+    # Drop the connection partway through the payload, like a device losing Wi-Fi
+    server_errors = logging.handlers.BufferingHandler(1000)
+    server_errors.setLevel(logging.ERROR)
+    logging.getLogger().addHandler(server_errors)
+    server_output = StringIO()
+    with contextlib.redirect_stderr(server_output):
+        with requests.get(payload_url, stream=True) as response:
+            etag = response.headers["ETag"]
+            partial = response.raw.read(1000000)
+
+        transfers = updater_server.metrics.devices["127.0.0.1"]
+        deadline = time.monotonic() + 10
+        while transfers.active_transfers and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    logging.getLogger().removeHandler(server_errors)
+    assert_value(
+        "updater logs no error on disconnect",
+        (server_errors.buffer, "Traceback" in server_output.getvalue()),
+        ([], False)
+    )
+    assert_gt("updater counts bytes sent before disconnect", transfers.bytes_served, len(partial))
+
+    response = requests.get(payload_url, headers={"Range": f"bytes={len(partial)}-", "If-Range": etag})
+    assert_value("updater resumes payload", (response.status_code, partial + response.content), (206, payload))
+
+    response = requests.get(payload_url, headers={"Range": "bytes=10-", "If-Range": '"outdated"'})
+    assert_value("updater ignores stale range", (response.status_code, response.content), (200, payload))
+
+    response = requests.get(payload_url, headers={"Range": f"bytes={len(payload)}-"})
+    assert_value("updater rejects unsatisfiable range", response.status_code, 416)
+
+    assert_value(
+        "updater only serves payloads",
+        requests.get(payload_url.replace("/updates/", "/")).status_code,
+        404
+    )
+
+    with requests.Session() as session:
+        served_before = transfers.bytes_served
+        response = session.get(payload_url, headers={"Range": "bytes=10-"})
+        assert_value("updater serves ranges", (response.status_code, response.content), (206, payload[10:]))
+        assert_value("updater counts bytes served", transfers.bytes_served - served_before, len(payload) - 10)
+        session.post(
+            updater_url,
+            data='<request protocol="3.0"><os platform="reMarkable2"/><app machineid="{device-a}"><event eventtype="14" eventresult="1"/></app></request>'
+        )
+
+    metrics = requests.get(updater_url + "metrics").text
+    assert_value(
+        "updater serves metrics",
+        f'codexctl_updater_bytes_served_total{{address="127.0.0.1",machine_id="device-a"}} {transfers.bytes_served}' in metrics,
+        True
+    )
+
+    completion = updater_server.completion("device-a", timeout=5)
+    assert_value("updater reports completion", (completion.event_type, completion.success), (14, True))
+    with assert_raises("updater completion times out", TimeoutError):
+        updater_server.completion("device-b", timeout=0.1)
+
+    def check_update(machine_id, platform="reMarkable2"):
+        request = (
+            f'<request protocol="3.0" version="3.2.3.1595"><os platform="{platform}"/>'
+            f'<app machineid="{machine_id}" bootid="{{boot-{machine_id}}}"><updatecheck/></app></request>'
+        )
+        response = requests.post(updater_url, data=request)
+        manifest = ET.fromstring(response.content).find("app/updatecheck/manifest")
+        return None if manifest is None else manifest.attrib["version"]
+
+    updater_server.route("device-a", "3.3.2.1666", "3.3.2.1666_reMarkable2-test.signed")
+    updater_server.route("boot-device-b", "3.3.2.1666", "3.3.2.1666_reMarkable2-test.signed")
+    assert_value("updater routes by machine id", check_update("device-a"), "3.3.2.1666")
+    assert_value("updater routes by boot id", check_update("device-b"), "3.3.2.1666")
+    assert_value("updater serves default version", check_update("device-c"), "3.5.2.1807")
+    assert_value("updater has no update for platform", check_update("device-c", "reMarkable1"), None)
+
+    updater_server.unroute("device-a")
+    assert_value("updater removes route", check_update("device-a"), "3.5.2.1807")
+    os.chdir(orig_cwd)
+
 if FAILED:
     sys.exit(1)